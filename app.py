@@ -1,109 +1,219 @@
-from flask import Flask, jsonify, request, make_response
-import bcrypt
+# First, so that startup timing includes the imports below
+import startup
+from flask import Flask, Response, g, jsonify, request, make_response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import logging
 import os
-from flasgger import swag_from
-from swagger.config import init_swagger
+import random
+import time
+from docs import ApiDocs, swag_from
 import user
 import auth
+import changes
+import concurrency
+import revocation
+import refresh
+import hashing
+import logs
+import metrics
+import profiling
+import ratelimit
+import signing
+from precomputed import PrecomputedResponse
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+# JSON logs through a background writer (see logs.py)
+logs.configure()
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider recording encoding time as the 'serialization' stage."""
+
+    def dumps(self, obj, **kwargs):
+        with metrics.timed('serialization', 'json'):
+            return super().dumps(obj, **kwargs)
+
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 
 # Configuration
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
-# Initialize Swagger
-init_swagger(app)
+# Largest page a client can request from GET /users
+USERS_PAGE_LIMIT = int(os.getenv('USERS_PAGE_LIMIT', 1000))
+# Number of users encoded per chunk of a streamed response
+STREAM_CHUNK_SIZE = 500
+# Largest number of rows accepted by one bulk request
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', 10000))
 
 # ----------------------------------------------------- Private functions
 def _check_password(check_password, id):
     status, result = user.get_user_password(id)
 
     if status != 200:
-        return jsonify(result), status
+        return False
+
+    return hashing.check_password(check_password, result)
+
+def _token_response(message, access_token, refresh_token, status=200):
+    response = make_response(jsonify({
+        "message": message,
+        "Authorization": access_token,
+        "refresh_token": refresh_token,
+        "expires_in": auth.ACCESS_TOKEN_TTL
+    }), status)
+
+    # Automatically set the tokens as cookies
+    response.set_cookie('Authorization', access_token, httponly=True, secure=True)
+    response.set_cookie('Refresh', refresh_token, max_age=refresh.REFRESH_TOKEN_TTL, httponly=True, secure=True)
+
+    return response
+
+def _request_refresh_token():
+    data = request.get_json(silent=True)
+
+    if isinstance(data, dict) and data.get('refresh_token'):
+        return data['refresh_token']
+
+    return request.cookies.get('Refresh')
+
+def _audit(event, status, **fields):
+    # The actor is the subject of the token a role_required view was called with
+    token = g.get('token')
+    logs.audit(event, actor=token['sub'] if token else None, client=request.remote_addr, status=status, **fields)
+
+def _start_profile():
+    mode = request.headers.get(profiling.PROFILE_HEADER)
+
+    if mode is not None:
+        # Profiles on demand are for admins; for anyone else the header is ignored
+        if not auth.request_has_role('admin'):
+            return
+    elif not profiling.PROFILE_SAMPLE_RATE or random.random() >= profiling.PROFILE_SAMPLE_RATE or request.path.startswith('/profiles'):
+        return
+
+    g.profiler = profiling.start(mode if mode in profiling.MODES else None)
+
+def _int_arg(name, minimum=0, maximum=None):
+    value = request.args.get(name)
+
+    if value is None or value == '':
+        return None
+
+    if not value.isdigit() or int(value) < minimum or (maximum is not None and int(value) > maximum):
+        limits = f"between {minimum} and {maximum}" if maximum is not None else f"at least {minimum}"
+        raise ValueError(f"'{name}' must be an integer {limits}")
+
+    return int(value)
+
+def _stream_json_array(items):
+    # Encode a few hundred items at a time so memory stays flat however many
+    # rows there are, without a write for every single item
+    def generate():
+        prefix = '['
+        chunk = []
+        for item in items:
+            chunk.append(app.json.dumps(item, separators=(',', ':')))
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield prefix + ','.join(chunk)
+                prefix = ','
+                chunk = []
+
+        yield (prefix + ','.join(chunk) if chunk or prefix == '[' else '') + ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def _bulk_rows():
+    # A bulk body is either a JSON array or newline-delimited JSON objects
+    if request.mimetype == 'application/x-ndjson':
+        rows = [app.json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+    else:
+        rows = request.get_json(silent=True)
+
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("Expected a JSON array or NDJSON of objects")
+
+    if len(rows) > BULK_MAX_ROWS:
+        raise ValueError(f"At most {BULK_MAX_ROWS} rows can be sent in one request")
+
+    return rows
 
-    return bcrypt.checkpw(check_password.encode('utf-8'), result)
+def _bulk_response(results):
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+
+    return jsonify({
+        "results": results,
+        "summary": {str(status): count for status, count in summary.items()}
+    }), 200
+
+# ----------------------------------------------------- Request hooks
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+    # Under asgi.py the request took its slot before waiting for a thread
+    if not request.environ.get('asgi.scope', {}).get('concurrency.acquired'):
+        # Raises Overloaded (503) before the request does any work
+        g.concurrency_limit = concurrency.acquire(request.path)
+    _start_profile()
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are counted when their headers are sent
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        seconds = time.perf_counter() - g.request_start
+        metrics.observe_request(request.method, route, response.status_code, seconds)
+        logs.access(request.method, request.path, route, response.status_code, seconds, request.remote_addr)
+
+    if g.get('profiler'):
+        response.headers['X-Profile-Id'] = g.profiler.id
+        g.profile_status = response.status_code
+
+    return response
+
+@app.teardown_request
+def release_concurrency_limit(exc):
+    # After a streamed response has been sent in full
+    limit = g.pop('concurrency_limit', None)
+
+    if limit is not None:
+        limit.release(time.perf_counter() - g.request_start, overloaded=g.get('overloaded', False))
+    elif g.get('overloaded') and 'asgi.scope' in request.environ:
+        # For asgi.py, which releases the slot
+        request.environ['asgi.scope']['concurrency.overloaded'] = True
+
+@app.teardown_request
+def save_profile(exc):
+    profiler = g.pop('profiler', None)
+
+    if profiler:
+        try:
+            profiling.finish(profiler, request.method, request.path, g.get('profile_status', 500), time.perf_counter() - g.request_start)
+        except OSError:
+            logging.getLogger('profiling').exception('Could not save profile %s', profiler.id)
 
 # ----------------------------------------------------- GET /
 @app.route('/', methods=['GET'])
 def service_info():
-    return jsonify({
-        "service": "User Management Microservice",
-        "description": "This microservice handles user-related operations such as registration, login, role management, and user updates.",
-        "endpoints": [
-            {
-                "path": "/register",
-                "method": "POST",
-                "description": "Register a new user",
-                "response": "JSON object with success or error message",
-                "role_required": "none"
-            },
-            {
-                "path": "/login",
-                "method": "POST",
-                "description": "Authenticate a user and return a token",
-                "response": "JSON object with token or error message",
-                "role_required": "none"
-            },
-            {
-                "path": "/users",
-                "method": "GET",
-                "description": "Retrieve a list of all users",
-                "response": "JSON array of user objects",
-                "role_required": "admin"
-            },
-            {
-                "path": "/users/<int:id>",
-                "method": "PATCH",
-                "description": "Update email or password of a specific user",
-                "response": "JSON object with success or error message",
-                "role_required": "admin"
-            },
-            {
-                "path": "/users/<int:id>/add-role",
-                "method": "PATCH",
-                "description": "Add a role to a specific user",
-                "response": "JSON object with success or error message",
-                "role_required": "admin"
-            },
-            {
-                "path": "/users/<int:id>/remove-role",
-                "method": "PATCH",
-                "description": "Remove a role from a specific user",
-                "response": "JSON object with success or error message",
-                "role_required": "admin"
-            },
-            {
-                "path": "/users/<int:id>",
-                "method": "DELETE",
-                "description": "Delete a user by ID",
-                "response": "JSON object with success or error message",
-                "role_required": "admin"
-            },
-            {
-                "path": "/health",
-                "method": "GET",
-                "description": "Check the health status of the microservice",
-                "response": "JSON object indicating the health status",
-                "role_required": "none"
-            },
-            {
-                "path": "/logout",
-                "method": "POST",
-                "description": "Logout and delete the authorization cookie",
-                "response": "JSON object with a success message",
-                "role_required": "none"
-            }
-        ]
-    })
+    """Describe this microservice and its endpoints
+
+    Response: JSON object with the service description and endpoint catalogue
+    """
+    return SERVICE_INFO.response()
 
 # ----------------------------------------------------- POST /register
 @app.route('/register', methods=['POST'])
 @swag_from('swagger/register.yaml')
 def register():
+    """Register a new user
+
+    Response: JSON object with success or error message
+    """
     data = request.json
     
     if not data or 'email' not in data or 'password' not in data:
@@ -113,7 +223,7 @@ def register():
     password = data['password']
     
     # Hash the password
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed = hashing.hash_password(password)
     
     status, result = user.register_user(
         {
@@ -122,12 +232,17 @@ def register():
         }
     )
 
+    _audit('user.registered', status, email=email)
     return jsonify(result), status
 
 # ----------------------------------------------------- POST /login
 @app.route('/login', methods=['POST'])
 @swag_from('swagger/login.yaml')
 def login():
+    """Authenticate a user and return an access token and a refresh token
+
+    Response: JSON object with tokens or error message
+    """
     data = request.json
     
     if not data or 'email' not in data or 'password' not in data:
@@ -135,37 +250,228 @@ def login():
     
     email = data['email']
     password = data['password']
+
+    # Before any database or bcrypt work; raises RateLimited (429)
+    ratelimit.check_login(request.remote_addr, email)
     
-    status, result = user.get_user_by_email(email)
+    status, result = user.get_user_credentials(email)
     
-    if status != 200:
+    if status not in (200, 404):
         return jsonify(result), status
+
+    # An unknown email is checked against a dummy hash, so it is refused as
+    # slowly as a wrong password and with the same response
+    found = status == 200
     
-    if result and _check_password(password, result['password']):
+    if hashing.check_password(password, result['password'] if found else None) and found:
+        ratelimit.login_succeeded(email)
+        user.upgrade_password_hash(result['id'], password, result['password'])
+        _audit('login.succeeded', 200, email=email, user_id=result['id'])
         access_token = auth.create_token(email, result['roles'])
 
-        # Create the response and add the token to the Authorization header 
-        response = make_response(jsonify({ "message": "Login successful", "Authorization": access_token}), status) 
-        # Automatically set token as a cookie
-        response.set_cookie('Authorization', access_token, httponly=True, secure=True)
-        
-        return response
-    
+        refresh_status, refresh_token = refresh.issue(result['id'])
+        if refresh_status != 201:
+            return jsonify(refresh_token), refresh_status
+
+        return _token_response("Login successful", access_token, refresh_token, status)
+
+    ratelimit.login_failed(email)
+    _audit('login.failed', 401, email=email)
     return jsonify({"error": "Invalid email or password"}), 401
 
+# ----------------------------------------------------- POST /token/refresh
+@app.route('/token/refresh', methods=['POST'])
+@swag_from('swagger/token_refresh.yaml')
+def refresh_token():
+    """Exchange a refresh token for a new access token and refresh token
+
+    Response: JSON object with tokens or error message
+    """
+    token = _request_refresh_token()
+
+    if not token:
+        return jsonify({"error": "Missing refresh token"}), 400
+
+    status, result = refresh.rotate(token)
+
+    if status != 200:
+        return jsonify(result), status
+
+    new_refresh_token, user_id = result
+
+    # Roles are read again, so changes since the last token take effect
+    status, result = user.get_user(user_id)
+
+    if status != 200:
+        return jsonify({"error": "Invalid or expired refresh token. Please log in again."}), 401
+
+    access_token = auth.create_token(result['email'], result['roles'])
+    return _token_response("Token refreshed", access_token, new_refresh_token)
+
+# ----------------------------------------------------- POST /tokens/introspect
+@app.route('/tokens/introspect', methods=['POST'])
+@auth.role_required(*auth.SERVICE_ROLES)
+@swag_from('swagger/tokens_introspect.yaml')
+def introspect_tokens():
+    """Check a batch of access tokens: validity, subject, roles and expiry of each
+
+    Response: JSON object with a result for each token, in the same order
+    """
+    status, result = auth.introspect_tokens(request.get_json(silent=True))
+    return jsonify(result), status
+
 # ----------------------------------------------------- GET /users
 @app.route('/users', methods=['GET'])
 @auth.role_required('admin') 
 @swag_from('swagger/get_users.yaml')
 def get_users():
-    status, result = user.get_users()
+    """Retrieve a list of users, optionally paginated (after_id, limit) and filtered (role, email_prefix)
+
+    Response: JSON array of user objects
+    """
+    try:
+        after_id = _int_arg('after_id')
+        limit = _int_arg('limit', minimum=1, maximum=USERS_PAGE_LIMIT)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    status, result = user.get_users(
+        after_id=after_id,
+        limit=limit,
+        role=request.args.get('role'),
+        email_prefix=request.args.get('email_prefix')
+    )
+
+    if status != 200:
+        return jsonify(result), status
+
+    return _stream_json_array(result)
+
+# ----------------------------------------------------- GET /changes
+@app.route('/changes', methods=['GET'])
+@auth.role_required(*auth.SERVICE_ROLES)
+@swag_from('swagger/changes.yaml')
+def get_changes():
+    """Changes to users and roles after a cursor (since), optionally waiting for one (wait)
+
+    Response: JSON object with the changes in order and the cursor to read on from
+    """
+    try:
+        since, limit, wait = changes.parse_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    status, result = changes.poll(since, limit, wait)
     return jsonify(result), status
-    
+
+# ----------------------------------------------------- POST /users/bulk
+@app.route('/users/bulk', methods=['POST'])
+@auth.role_required('admin')
+@swag_from('swagger/users_bulk.yaml')
+def register_users_bulk():
+    """Register many users in one transaction (JSON array or NDJSON)
+
+    Response: JSON object with a result for each user
+    """
+    try:
+        rows = _bulk_rows()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = [None] * len(rows)
+    seen = set()
+    valid = []
+
+    for i, row in enumerate(rows):
+        email = row.get('email')
+        password = row.get('password')
+        roles = row.get('roles')
+
+        if not isinstance(email, str) or not email or not isinstance(password, str) or not password:
+            results[i] = {"email": email, "status": 400, "message": "Missing email or password"}
+        elif roles is not None and (not isinstance(roles, list) or not all(isinstance(role, str) and role for role in roles)):
+            results[i] = {"email": email, "status": 400, "message": "roles must be a list of role names"}
+        elif email in seen:
+            results[i] = {"email": email, "status": 409, "message": "Duplicate email in request"}
+        else:
+            seen.add(email)
+            valid.append(i)
+
+    # Skip hashing passwords for accounts that already exist
+    status, existing = user.get_existing_emails([rows[i]['email'] for i in valid])
+    if status != 200:
+        return jsonify(existing), status
+
+    for i in valid:
+        if rows[i]['email'] in existing:
+            results[i] = {"email": rows[i]['email'], "status": 409, "message": "A user with this email already exists"}
+
+    valid = [i for i in valid if results[i] is None]
+    hashes = hashing.hash_passwords([rows[i]['password'] for i in valid])
+
+    status, inserted = user.register_users([
+        {"email": rows[i]['email'], "password": hashed, "roles": rows[i].get('roles')}
+        for i, hashed in zip(valid, hashes)
+    ])
+    if status != 200:
+        return jsonify(inserted), status
+
+    for i, result in zip(valid, inserted):
+        results[i] = result
+
+    _audit('users.bulk_registered', 200, emails=[result['email'] for result in inserted if result['status'] == 201])
+    return _bulk_response(results)
+
+# ----------------------------------------------------- PATCH /roles/bulk
+@app.route('/roles/bulk', methods=['PATCH'])
+@auth.role_required('admin')
+@swag_from('swagger/roles_bulk.yaml')
+def update_roles_bulk():
+    """Add or remove many user roles in one transaction (JSON array or NDJSON)
+
+    Response: JSON object with a result for each role change
+    """
+    try:
+        rows = _bulk_rows()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = [None] * len(rows)
+    valid = []
+
+    for i, row in enumerate(rows):
+        has_new_role = isinstance(row.get('new_role'), str) and row['new_role']
+        has_remove_role = isinstance(row.get('remove_role'), str) and row['remove_role']
+
+        if not isinstance(row.get('id'), int) or isinstance(row.get('id'), bool):
+            results[i] = {"id": row.get('id'), "status": 400, "message": "Missing or invalid user id"}
+        elif bool(has_new_role) == bool(has_remove_role):
+            results[i] = {"id": row['id'], "status": 400, "message": "Give exactly one of new_role or remove_role"}
+        else:
+            valid.append(i)
+
+    status, updated = user.update_roles([rows[i] for i in valid])
+    if status != 200:
+        return jsonify(updated), status
+
+    for i, result in zip(valid, updated):
+        results[i] = result
+
+    _audit('roles.bulk_updated', 200, changes=[
+        {key: rows[i][key] for key in ('id', 'new_role', 'remove_role') if key in rows[i]}
+        for i, result in zip(valid, updated) if result['status'] < 300
+    ])
+    return _bulk_response(results)
+
 # ----------------------------------------------------- PATCH /users/id
 @app.route('/users/<int:id>', methods=['PATCH'])
 @auth.role_required('admin') 
 @swag_from('swagger/patch_user.yaml') 
 def patch_user(id):
+    """Update email or password of a specific user
+
+    Response: JSON object with success or error message
+    """
     data = request.json
 
     email = data.get('email')
@@ -174,20 +480,23 @@ def patch_user(id):
 
     if email and new_password and old_password:
         if _check_password(old_password, id):
-            hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+            hashed_password = hashing.hash_password(new_password)
             status, result = user.update_user(id, {"email": email, "password": hashed_password})
+            _audit('user.updated', status, user_id=id, fields=['email', 'password'])
             return jsonify(result), status
         
         return jsonify({"message": "Wrong old password"}), 404
     
     elif email:
         status, result = user.update_user(id, {"email": email})
+        _audit('user.updated', status, user_id=id, fields=['email'])
         return jsonify(result), status
     
     elif new_password and old_password:
         if _check_password(old_password, id):
-            hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+            hashed_password = hashing.hash_password(new_password)
             status, result = user.update_user(id, {"password": hashed_password})
+            _audit('user.updated', status, user_id=id, fields=['password'])
             return jsonify(result), status
         
         return jsonify({"message": "Wrong old password"}), 404
@@ -199,17 +508,17 @@ def patch_user(id):
 @auth.role_required('admin') 
 @swag_from('swagger/user_add_role.yaml')
 def user_add_role(id):
+    """Add a role to a specific user
+
+    Response: JSON object with success or error message
+    """
     data = request.json
 
     new_role = data.get('new_role')
 
     if new_role:
-        status, result = user.get_user(id)
-
-        if status == 200:
-            role_status, role_result = user.add_role(result['email'], new_role)
-            
-            return jsonify(role_result), role_status
+        status, result = user.add_role(id, new_role)
+        _audit('role.added', status, user_id=id, role=new_role)
 
         return jsonify(result), status
 
@@ -220,17 +529,17 @@ def user_add_role(id):
 @auth.role_required('admin') 
 @swag_from('swagger/user_remove_role.yaml')
 def user_remove_role(id):
+    """Remove a role from a specific user
+
+    Response: JSON object with success or error message
+    """
     data = request.json
 
     remove_role = data.get('remove_role')
 
     if remove_role:
-        status, result = user.get_user(id)
-
-        if status == 200:
-            role_status, role_result = user.remove_role(result['email'], remove_role)
-            
-            return jsonify(role_result), role_status
+        status, result = user.remove_role(id, remove_role)
+        _audit('role.removed', status, user_id=id, role=remove_role)
 
         return jsonify(result), status
 
@@ -242,24 +551,152 @@ def user_remove_role(id):
 @auth.role_required('admin') 
 @swag_from('swagger/delete_user.yaml')
 def delete_user(id):
+    """Delete a user by ID
+
+    Response: JSON object with success or error message
+    """
     status, result = user.delete_user(id)
+    _audit('user.deleted', status, user_id=id)
     return jsonify(result), status
 
 
 # ----------------------------------------------------- POST /logout
 @app.route('/logout', methods=['POST'])
 def logout():
+    """Logout, revoke the tokens and delete their cookies
+
+    Response: JSON object with a success message
+    """
+    # Revoke the tokens themselves, not just the cookies holding them
+    token = auth.get_request_token()
+    if token:
+        status, result = auth.revoke_token(token)
+
+        if status == 500:
+            return jsonify(result), status
+
+    token = _request_refresh_token()
+    if token:
+        status, result = refresh.revoke(token)
+
+        if status == 500:
+            return jsonify(result), status
+
     response = make_response(jsonify({"message": "Logout successful"}))
     
-    # Set the cookie with the same name to expire in the past so the browser will delete the cookie
+    # Set the cookies with the same name to expire in the past so the browser will delete the cookies
     response.set_cookie('Authorization', '', expires=0, httponly=True, secure=True)
+    response.set_cookie('Refresh', '', expires=0, httponly=True, secure=True)
     
     return response
 
+# ----------------------------------------------------- GET /stats
+@app.route('/stats', methods=['GET'])
+@auth.role_required('admin')
+@swag_from('swagger/stats.yaml')
+def stats():
+    """Hit, miss and size counters of the in-process token and user caches
+
+    Response: JSON object with cache statistics
+    """
+    return jsonify({
+        "token_cache": auth.token_cache_stats(),
+        "user_cache": user.cache_stats(),
+        "revoked_tokens": revocation.stats()
+    }), 200
+
+# ----------------------------------------------------- GET /metrics
+@app.route('/metrics', methods=['GET'])
+@swag_from('swagger/metrics.yaml')
+def get_metrics():
+    """Request counts, latency histograms per route and per stage (db, bcrypt, jwt, serialization) and error counters
+
+    Response: Prometheus text format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ----------------------------------------------------- GET /profiles
+@app.route('/profiles', methods=['GET'])
+@auth.role_required('admin')
+@swag_from('swagger/profiles.yaml')
+def get_profiles():
+    """List the stored request profiles, newest first
+
+    Response: JSON array of profiles with their request, status, duration and download path
+    """
+    return jsonify([
+        dict(profile, download=f"/profiles/{profile['id']}")
+        for profile in profiling.list_profiles()
+    ]), 200
+
+# ----------------------------------------------------- GET /profiles/id
+@app.route('/profiles/<profile_id>', methods=['GET'])
+@auth.role_required('admin')
+@swag_from('swagger/profile_download.yaml')
+def download_profile(profile_id):
+    """Download a request profile as a pstats or speedscope file
+
+    Response: pstats file (cprofile) or speedscope JSON (sampling)
+    """
+    profile = profiling.load_profile(profile_id)
+
+    if profile is None:
+        return jsonify({"message": "Profile not found"}), 404
+
+    data, mimetype, filename = profile
+    return Response(data, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# ----------------------------------------------------- GET /.well-known/jwks.json
+@app.route('/.well-known/jwks.json', methods=['GET'])
+@swag_from('swagger/jwks.yaml')
+def jwks():
+    """Public keys that verify the access tokens, for services checking tokens themselves
+
+    Response: JSON Web Key Set (empty when tokens are signed with HS256)
+    """
+    return signing.JWKS_RESPONSE.response()
+
 # ----------------------------------------------------- GET /health
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy"}), 200
+    """Check the health status of the microservice
+
+    Response: JSON object indicating the health status
+    """
+    return HEALTH.response()
+
+# ----------------------------------------------------- GET /ready
+@app.route('/ready', methods=['GET'])
+@swag_from('swagger/ready.yaml')
+def readiness_check():
+    """Check whether this process is ready for more requests: database latency and load
+
+    Response: JSON object with the status and each check, 503 when not ready
+    """
+    status, result = concurrency.readiness()
+    return jsonify(result), status
+
+# ----------------------------------------------------- Error handlers
+@app.errorhandler(hashing.HashingBusy)
+def hashing_busy_503(e):
+    # Shrinks the route class's concurrency limit
+    g.overloaded = True
+    response = make_response(jsonify({"message": str(e)}), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.errorhandler(concurrency.Overloaded)
+def overloaded_503(e):
+    response = make_response(jsonify({"message": str(e)}), 503)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.errorhandler(ratelimit.RateLimited)
+def rate_limited_429(e):
+    _audit('login.rate_limited', 429, reason=str(e))
+    response = make_response(jsonify({"message": str(e)}), 429)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
 
 # ----------------------------------------------------- Catch-all route for unmatched endpoints
 @app.errorhandler(404)
@@ -270,5 +707,59 @@ def page_not_found_404(e):
 def page_not_found_405(e):
     return jsonify({"message": "Method not allowed - double check the method you are using"}), 405
 
+# ----------------------------------------------------- Precomputed responses
+SERVICE_DESCRIPTION = "This microservice handles user-related operations such as registration, login, role management, and user updates."
+
+def endpoint_catalogue():
+    """Describe every route of this app (not the Swagger UI's) from its view:
+    the first docstring line, the 'Response:' line, and the roles recorded by
+    auth.role_required."""
+    endpoints = []
+
+    for rule in app.url_map.iter_rules():
+        view = app.view_functions[rule.endpoint]
+        if rule.endpoint == 'static' or '.' in rule.endpoint or not view.__doc__:
+            continue
+
+        lines = [line.strip() for line in view.__doc__.strip().splitlines()]
+        response = next((line[len('Response:'):].strip() for line in lines if line.startswith('Response:')), "")
+        roles = getattr(view, 'required_roles', ())
+
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            endpoints.append({
+                "path": rule.rule,
+                "method": method,
+                "description": lines[0],
+                "response": response,
+                "role_required": ", ".join(roles) or "none"
+            })
+
+    return endpoints
+
+# Encoded once: these routes are polled by probes and gateways, and their
+# content only changes with a deployment
+SERVICE_INFO = PrecomputedResponse(app.json.dumps({
+    "service": "User Management Microservice",
+    "description": SERVICE_DESCRIPTION,
+    "endpoints": endpoint_catalogue()
+}))
+HEALTH = PrecomputedResponse(app.json.dumps({"status": "healthy"}))
+
+# Swagger UI and spec, loaded according to SWAGGER_MODE (see docs.py)
+with startup.phase('docs'):
+    docs = ApiDocs(app)
+    app.wsgi_app = docs.wsgi_app(app.wsgi_app)
+
+startup.report()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5005)))
+    port = int(os.environ.get('PORT', 5005))
+
+    if os.getenv('SERVER_MODE', 'dev') == 'asgi':
+        # Production: uvicorn worker processes serving asgi.application
+        import uvicorn
+        # Requests are logged by logs.access instead of uvicorn's access log
+        uvicorn.run('asgi:application', host='0.0.0.0', port=port, workers=int(os.getenv('WEB_CONCURRENCY', 1)), access_log=False)
+    else:
+        hashing.start()
+        app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,402 @@
+"""ASGI entry point for production serving, e.g. `uvicorn asgi:application`.
+
+POST /login, POST /register, POST /tokens/introspect and GET /changes are
+served natively on the event loop: their database calls run in a small
+thread pool and bcrypt runs in the hashing pool, so a login waiting on either
+holds no thread, nor does a long-poll of GET /changes. GET /ready runs its
+checks in the same thread pool. GET /, /health, /.well-known/jwks.json and
+/apispec.json are answered straight from the bodies app.py, signing.py and
+docs.py encoded once. Every other route is handed to the Flask app through a
+WSGI bridge with its own thread pool.
+
+All routes count against the concurrency limits of concurrency.py here, the
+Flask routes before they wait for a thread of the bridge: its queue has no
+bound, so a request waiting in it must hold a slot, or overload would pile
+up there instead of being shed.
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import dump_cookie, parse_cookie
+from app import app, docs, SERVICE_INFO, HEALTH
+import user
+import auth
+import changes
+import concurrency
+import hashing
+import logs
+import ratelimit
+import refresh
+import signing
+import metrics
+import profiling
+
+# Threads serving the Flask (WSGI) routes, per worker process
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', 16))
+# Threads running database calls for the async routes, per worker process
+DB_THREADS = int(os.getenv('DB_THREADS', 8))
+# Largest request body the async routes will read
+MAX_BODY_SIZE = 64 * 1024
+
+_wsgi = WSGIMiddleware(app, workers=WSGI_THREADS)
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+_url_adapter = app.url_map.bind('localhost')
+_PROFILE_HEADER = profiling.PROFILE_HEADER.lower().encode('latin-1')
+
+# ----------------------------------------------------- Private functions
+async def _db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
+async def _hashing(operation, future):
+    try:
+        with metrics.timed('bcrypt', operation):
+            return await asyncio.wait_for(asyncio.wrap_future(future), hashing.HASH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise hashing.HashingBusy("Password operation timed out, please try again shortly")
+
+async def _read_json(receive, max_size=MAX_BODY_SIZE):
+    body = b''
+    more_body = True
+
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if len(body) > max_size:
+            return None
+
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+async def _send_json(send, status, data, headers=()):
+    # app.json records the encoding time as the 'serialization' stage
+    body = app.json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1')),
+            *[(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _limits(fn, *args):
+    # The in-memory store is a dict lookup; the shared one is a query
+    if ratelimit.RATE_LIMIT_STORE == 'memory':
+        return fn(*args)
+    return await _db(fn, *args)
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def _client(scope):
+    client = scope.get('client')
+    return client[0] if client else None
+
+def _route(scope):
+    # The Flask rule the path matches, as app.py labels its requests
+    try:
+        rule, _ = _url_adapter.match(scope['path'], scope['method'], return_rule=True)
+        return rule.rule
+    except HTTPException:
+        return 'unmatched'
+
+def _credentials(data):
+    if not isinstance(data, dict) or 'email' not in data or 'password' not in data:
+        return None
+
+    return data['email'], data['password']
+
+# ----------------------------------------------------- POST /register
+async def register(scope, receive, send):
+    credentials = _credentials(await _read_json(receive))
+
+    if not credentials:
+        return await _send_json(send, 400, {"error": "Missing email or password"})
+
+    email, password = credentials
+
+    # Hash the password
+    hashed = await _hashing('hash', hashing.submit_hash(password))
+
+    status, result = await _db(user.register_user, {
+        'email': email,
+        'password': hashed
+    })
+
+    logs.audit('user.registered', actor=None, client=_client(scope), status=status, email=email)
+    await _send_json(send, status, result)
+
+# ----------------------------------------------------- POST /login
+async def login(scope, receive, send):
+    credentials = _credentials(await _read_json(receive))
+
+    if not credentials:
+        return await _send_json(send, 400, {"error": "Missing email or password"})
+
+    email, password = credentials
+
+    # Before any database or bcrypt work; raises RateLimited (429)
+    await _limits(ratelimit.check_login, _client(scope), email)
+
+    status, result = await _db(user.get_user_credentials, email)
+
+    if status not in (200, 404):
+        return await _send_json(send, status, result)
+
+    # An unknown email is checked against a dummy hash, so it is refused as
+    # slowly as a wrong password and with the same response
+    found = status == 200
+
+    if await _hashing('check', hashing.submit_check(password, result['password'] if found else None)) and found:
+        await _limits(ratelimit.login_succeeded, email)
+        user.upgrade_password_hash(result['id'], password, result['password'])
+        logs.audit('login.succeeded', actor=None, client=_client(scope), status=200, email=email, user_id=result['id'])
+        access_token = auth.create_token(email, result['roles'])
+
+        refresh_status, refresh_token = await _db(refresh.issue, result['id'])
+        if refresh_status != 201:
+            return await _send_json(send, refresh_status, refresh_token)
+
+        return await _send_json(
+            send,
+            status,
+            {
+                "message": "Login successful",
+                "Authorization": access_token,
+                "refresh_token": refresh_token,
+                "expires_in": auth.ACCESS_TOKEN_TTL
+            },
+            # Automatically set the tokens as cookies
+            [
+                ('set-cookie', dump_cookie('Authorization', access_token, httponly=True, secure=True)),
+                ('set-cookie', dump_cookie('Refresh', refresh_token, max_age=refresh.REFRESH_TOKEN_TTL, httponly=True, secure=True))
+            ]
+        )
+
+    await _limits(ratelimit.login_failed, email)
+    logs.audit('login.failed', actor=None, client=_client(scope), status=401, email=email)
+    await _send_json(send, 401, {"error": "Invalid email or password"})
+
+# ----------------------------------------------------- POST /tokens/introspect
+def _request_token(scope):
+    # As auth.get_request_token: the cookie, then the header
+    return parse_cookie(_header(scope, b'cookie') or '').get('Authorization') or _header(scope, b'authorization')
+
+def _introspect(token, data):
+    status, result = auth.authorize(token, auth.SERVICE_ROLES)
+
+    if status != 200:
+        return [status, result]
+
+    return auth.introspect_tokens(data)
+
+async def introspect(scope, receive, send):
+    data = await _read_json(receive, auth.INTROSPECT_MAX_TOKENS * 2048)
+
+    # In the database pool: a stale revocation list is fetched by the
+    # request that finds it so
+    status, result = await _db(_introspect, _request_token(scope), data)
+
+    await _send_json(send, status, result)
+
+# ----------------------------------------------------- GET /changes
+# Set, then replaced, on the event loop after each commit that wrote changes,
+# so long-polls wake without a thread waiting for each
+_loop = None
+_changed = None
+
+def _signal_change():
+    global _changed
+
+    event, _changed = _changed, asyncio.Event()
+    event.set()
+
+def _on_change():
+    # Called from the thread that committed
+    if _loop is not None:
+        try:
+            _loop.call_soon_threadsafe(_signal_change)
+        except RuntimeError:
+            # The loop was closed
+            pass
+
+changes.subscribe(_on_change)
+
+async def get_changes(scope, receive, send):
+    global _loop, _changed
+
+    if _loop is not asyncio.get_running_loop():
+        _loop = asyncio.get_running_loop()
+        _changed = asyncio.Event()
+
+    status, result = await _db(auth.authorize, _request_token(scope), auth.SERVICE_ROLES)
+
+    if status != 200:
+        return await _send_json(send, status, result)
+
+    try:
+        since, limit, wait = changes.parse_query(dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))))
+    except ValueError as e:
+        return await _send_json(send, 400, {"error": str(e)})
+
+    # As changes.poll, waiting on the event instead of a thread
+    deadline = time.monotonic() + wait
+
+    while True:
+        changed = _changed
+        status, result = await _db(changes.read, since, limit)
+        remaining = deadline - time.monotonic()
+
+        if status != 200 or result['changes'] or remaining <= 0:
+            break
+
+        try:
+            await asyncio.wait_for(changed.wait(), min(remaining, changes.CHANGES_POLL_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+
+    await _send_json(send, status, result)
+
+# ----------------------------------------------------- GET /ready
+async def ready(scope, receive, send):
+    status, result = await _db(concurrency.readiness)
+    await _send_json(send, status, result)
+
+# ----------------------------------------------------- GET /, /health, /.well-known/jwks.json, /apispec.json
+async def _send_precomputed(scope, send, resource):
+    headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in resource.headers]
+
+    if resource.not_modified(_header(scope, b'if-none-match')):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers[1:]})
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    headers.append((b'content-length', str(len(resource.body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': resource.body})
+
+def precomputed(resource):
+    async def handler(scope, receive, send):
+        await _send_precomputed(scope, send, resource)
+
+    return handler
+
+async def apispec(scope, receive, send):
+    # With SWAGGER_MODE=lazy the first request builds the spec, off the event loop
+    resource = docs.spec or await asyncio.get_running_loop().run_in_executor(None, docs.apispec)
+
+    if resource is None:
+        return await _send_json(send, 404, {"message": "Endpoint does not exist"})
+
+    await _send_precomputed(scope, send, resource)
+
+# ----------------------------------------------------- Application
+ROUTES = {
+    ('POST', '/register'): register,
+    ('POST', '/login'): login,
+    ('POST', '/tokens/introspect'): introspect,
+    ('GET', '/changes'): get_changes,
+    ('GET', '/ready'): ready,
+    ('GET', '/'): precomputed(SERVICE_INFO),
+    ('GET', '/health'): precomputed(HEALTH),
+    ('GET', '/.well-known/jwks.json'): precomputed(signing.JWKS_RESPONSE),
+    ('GET', '/apispec.json'): apispec
+}
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            hashing.start()
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            hashing.shutdown()
+            _db_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def _flask(scope, receive, send):
+    if scope['type'] != 'http':
+        return await _wsgi(scope, receive, send)
+
+    start = time.perf_counter()
+
+    try:
+        limit = concurrency.acquire(scope['path'])
+    except concurrency.Overloaded as e:
+        await _send_json(send, 503, {"message": str(e)}, [('retry-after', str(e.retry_after))])
+        seconds = time.perf_counter() - start
+        metrics.observe_request(scope['method'], _route(scope), 503, seconds)
+        logs.access(scope['method'], scope['path'], _route(scope), 503, seconds, _client(scope))
+        return
+
+    # Tells app.py the request holds its slot already; app.py sets
+    # 'concurrency.overloaded' when the hashing pool turned it away
+    scope['concurrency.acquired'] = True
+
+    try:
+        await _wsgi(scope, receive, send)
+    finally:
+        if limit is not None:
+            limit.release(time.perf_counter() - start, scope.get('concurrency.overloaded', False))
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+
+    # Requests asking to be profiled go through Flask, which profiles them
+    if handler is not None and _header(scope, _PROFILE_HEADER) is not None:
+        handler = None
+
+    if handler is None:
+        return await _flask(scope, receive, send)
+
+    start = time.perf_counter()
+    status = 500
+    limit = None
+    overloaded = False
+
+    async def send_and_record_status(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        await send(message)
+
+    try:
+        # Raises Overloaded (503) before the request does any work
+        limit = concurrency.acquire(scope['path'])
+        await handler(scope, receive, send_and_record_status)
+    except concurrency.Overloaded as e:
+        await _send_json(send_and_record_status, 503, {"message": str(e)}, [('retry-after', str(e.retry_after))])
+    except hashing.HashingBusy as e:
+        overloaded = True
+        await _send_json(send_and_record_status, 503, {"message": str(e)}, [('retry-after', '1')])
+    except ratelimit.RateLimited as e:
+        logs.audit('login.rate_limited', actor=None, client=_client(scope), status=429, reason=str(e))
+        await _send_json(send_and_record_status, 429, {"message": str(e)}, [('retry-after', str(e.retry_after))])
+    finally:
+        seconds = time.perf_counter() - start
+
+        if limit is not None:
+            limit.release(seconds, overloaded)
+
+        metrics.observe_request(scope['method'], scope['path'], status, seconds)
+        logs.access(scope['method'], scope['path'], scope['path'], status, seconds, _client(scope))
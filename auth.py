@@ -1,52 +1,167 @@
-from flask import request, jsonify
+from flask import g, request, jsonify
 import os
 import jwt
 import datetime
+import hashlib
+import uuid
 from functools import wraps
 from dotenv import load_dotenv
+from cache import TTLCache
+import metrics
+import revocation
+import signing
 
 # Load environment variables from .env file
 load_dotenv()
-SECRET_KEY = os.getenv('SECRET_KEY')
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.getenv('TOKEN_CACHE_TTL', 300))
+# Lifetime of access tokens. Clients renew them with a refresh token (see
+# refresh.py), which also picks up role changes.
+ACCESS_TOKEN_TTL = int(os.getenv('ACCESS_TOKEN_TTL', 900))
+# Largest number of tokens checked by one POST /tokens/introspect
+INTROSPECT_MAX_TOKENS = int(os.getenv('INTROSPECT_MAX_TOKENS', 100))
+# Roles of the callers of the endpoints for other services, introspection
+# and the change feed: gateways and downstream services get 'service'
+SERVICE_ROLES = ('admin', 'service')
+
+# Payloads of tokens that already passed verification, keyed by a digest of
+# the token so the cache does not hold usable tokens in memory. An entry never
+# outlives the token's own 'exp'.
+_token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
 
 def create_token(email, roles):
     now = datetime.datetime.now(tz=datetime.timezone.utc)
     payload = {
-        'exp': now + datetime.timedelta(days=1),
+        'exp': now + datetime.timedelta(seconds=ACCESS_TOKEN_TTL),
         'iat': now,
         'sub': email,
-        'roles': roles
+        'roles': roles,
+        # Token id, for revoking this token at logout
+        'jti': uuid.uuid4().hex
     }
-    return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+    with metrics.timed('jwt', 'encode'):
+        # Signed with JWT_ALGORITHM, see signing.py
+        return signing.encode(payload)
 
 def decode_token(token):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        return payload
-    except jwt.ExpiredSignatureError:
-        return 'Token expired. Please log in again.'
-    except jwt.InvalidTokenError:
-        return 'Invalid token. Please log in again.'
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    payload = _token_cache.get(key)
+
+    if payload is None:
+        try:
+            with metrics.timed('jwt', 'decode'):
+                payload = signing.decode(token)
+            _token_cache.set(key, payload, expires_at=payload.get('exp'))
+        except jwt.ExpiredSignatureError:
+            return 'Token expired. Please log in again.'
+        except jwt.InvalidTokenError:
+            return 'Invalid token. Please log in again.'
+
+    # Checked on cache hits too, so a token revoked after it was cached is refused
+    if revocation.is_revoked(payload.get('jti')):
+        return 'Token revoked. Please log in again.'
+
+    return payload
+
+def get_request_token():
+    # Check for token in cookies, then in headers
+    return request.cookies.get('Authorization') or request.headers.get('Authorization')
+
+def request_has_role(*roles):
+    """Whether the current request carries a valid token with one of the roles,
+    for checks outside a role_required view."""
+    token = get_request_token()
+    payload = decode_token(token) if token else None
+
+    return isinstance(payload, dict) and any(role in payload.get('roles', ()) for role in roles)
+
+def introspect_token(token):
+    """What role_required makes of a token, as a dict: 'active' with the
+    token's claims, or not 'active' with the reason."""
+    if not isinstance(token, str) or not token:
+        return {"active": False, "error": "Token is missing"}
+
+    # Gateways pass on the Authorization header as they received it
+    if token.startswith('Bearer '):
+        token = token[len('Bearer '):]
+
+    payload = decode_token(token)
+
+    if isinstance(payload, str):
+        return {"active": False, "error": payload}
+
+    return {
+        "active": True,
+        "sub": payload.get('sub'),
+        "roles": payload.get('roles', []),
+        "exp": payload.get('exp'),
+        "iat": payload.get('iat'),
+        "jti": payload.get('jti')
+    }
+
+def introspect_tokens(data):
+    """Check the tokens of a {'tokens': [...]} request body, in order."""
+    tokens = data.get('tokens') if isinstance(data, dict) else None
+
+    if not isinstance(tokens, list) or not tokens:
+        return [400, {"error": "Give the tokens to check as a non-empty 'tokens' list"}]
 
+    if len(tokens) > INTROSPECT_MAX_TOKENS:
+        return [400, {"error": f"At most {INTROSPECT_MAX_TOKENS} tokens can be checked at once"}]
+
+    return [200, {"results": [introspect_token(token) for token in tokens]}]
+
+def revoke_token(token):
+    """Revoke a token until it expires. Tokens that are invalid, expired or
+    already revoked need no revoking."""
+    payload = decode_token(token)
+
+    if isinstance(payload, str) or not payload.get('jti'):
+        return [200, {"message": "Token is not valid"}]
+
+    return revocation.revoke(payload['jti'], payload['exp'])
+
+def clear_token_cache():
+    _token_cache.clear()
+
+def token_cache_stats():
+    return _token_cache.stats()
+
+metrics.add_collector(lambda: metrics.gauge_lines(
+    'token_cache', 'Verified-token cache counters',
+    {(key,): value for key, value in _token_cache.stats().items()},
+    ['stat']
+))
+
+
+def authorize(token, roles):
+    """Check that a token is valid and has one of the roles, as role_required
+    does. Returns [200, payload], or [401 or 403, error]."""
+    if not token:
+        return [401, {'message': 'Token is missing! You do not have permission to access this endpoint!'}]
+
+    # Decode the token
+    payload = decode_token(token)
+    if isinstance(payload, str):
+        return [401, {'message': payload}]
+
+    # Check for required roles
+    if not any(role in payload['roles'] for role in roles):
+        return [403, {'message': 'You do not have permission to access this endpoint!'}]
+
+    return [200, payload]
 
 def role_required(*roles):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # Check for token in cookies
-            token = request.cookies.get('Authorization')
-            if not token:
-                # Check for token in headers if not found in cookies
-                token = request.headers.get('Authorization')
-                if not token:
-                    return jsonify({'message': 'Token is missing! You do not have permission to access this endpoint!'}), 401
-
             try:
-                # Decode the token
-                payload = decode_token(token)
-                # Check for required roles
-                if not any(role in payload['roles'] for role in roles):
-                    return jsonify({'message': 'You do not have permission to access this endpoint!'}), 403
+                status, result = authorize(get_request_token(), roles)
+                if status != 200:
+                    return jsonify(result), status
+
+                # The caller, for the audit log
+                g.token = result
             except jwt.ExpiredSignatureError as e:
                 return jsonify({'message': str(e)}), 401
             except jwt.InvalidTokenError as e:
@@ -55,5 +170,8 @@ def role_required(*roles):
                 return jsonify({'message': str(e)}), 401
 
             return f(*args, **kwargs)
+
+        # Read by the endpoint catalogue served at GET /
+        decorated_function.required_roles = roles
         return decorated_function
     return decorator
@@ -0,0 +1,54 @@
+"""Compare two benchmark result files and fail on regressions.
+
+Usage: python -m benchmarks.compare baseline.json results.json [--threshold 0.15]
+
+A benchmark regresses when its p50 or p99 latency grows, or its throughput
+drops, by more than the threshold (a fraction, default 0.15). Exits with
+status 1 if anything regressed.
+"""
+import argparse
+import json
+import sys
+
+def changes(old, new):
+    """Relative change of each metric, signed so that positive is worse."""
+    result = {}
+    for key in ('p50_ms', 'p99_ms'):
+        if old.get(key) and new.get(key) is not None:
+            result[key] = (new[key] - old[key]) / old[key]
+    if old.get('throughput') and new.get('throughput') is not None:
+        result['throughput'] = (old['throughput'] - new['throughput']) / old['throughput']
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    parser.add_argument('--threshold', type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+
+    regressions = 0
+    for group in ('http', 'micro'):
+        for name, new in results.get(group, {}).items():
+            old = baseline.get(group, {}).get(name)
+            if old is None:
+                continue
+
+            worse = {key: value for key, value in changes(old, new).items() if value > args.threshold}
+            status = 'REGRESSED' if worse or new.get('errors', 0) > old.get('errors', 0) else 'ok'
+            if status != 'ok':
+                regressions += 1
+
+            details = ', '.join(f"{key} {value:+.0%}" for key, value in changes(old, new).items())
+            print(f"{status:9} {group:5} {name:36} {details}")
+
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""HTTP load benchmarks against the app served in-process on a free port."""
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+from benchmarks.stats import summarize
+
+class Server:
+    """Serve the app for the benchmark: 'wsgi' runs the Werkzeug threaded
+    server with the Flask app in this process, 'asgi' runs uvicorn with
+    asgi.py in a child process (with the same environment, so the same
+    database)."""
+
+    def __init__(self, mode='wsgi', workers=1):
+        self.mode = mode
+        self.workers = workers
+        self.port = None
+        self._server = None
+        self._thread = None
+        self._process = None
+
+    def start(self):
+        if self.mode == 'asgi':
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                self.port = sock.getsockname()[1]
+
+            self._process = subprocess.Popen([
+                sys.executable, '-m', 'uvicorn', 'asgi:application',
+                '--host', '127.0.0.1', '--port', str(self.port),
+                '--workers', str(self.workers), '--log-level', 'warning'
+            ])
+            self._wait_until_ready()
+        else:
+            from werkzeug.serving import WSGIRequestHandler, make_server
+            import app
+            import hashing
+
+            class QuietRequestHandler(WSGIRequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+
+            hashing.start()
+            self._server = make_server('127.0.0.1', 0, app.app, threaded=True, request_handler=QuietRequestHandler)
+            self.port = self._server.server_port
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def _wait_until_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError("uvicorn exited before it was ready")
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=1)
+                conn.request('GET', '/health')
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("uvicorn did not become ready")
+
+    def stop(self):
+        if self.mode == 'asgi':
+            self._process.terminate()
+            self._process.wait(timeout=10)
+        else:
+            self._server.shutdown()
+            self._thread.join(timeout=10)
+
+class NoDelayHTTPConnection(http.client.HTTPConnection):
+    # Without TCP_NODELAY, Nagle's algorithm and delayed ACKs add ~40 ms to
+    # small requests on a kept-alive connection
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def run_scenario(port, make_request, count, concurrency, ok_statuses=(200, 201)):
+    """Send count requests from concurrency threads and summarize the latencies.
+
+    make_request(i) returns (method, path, body, headers) for the i-th request.
+    Responses with a status outside ok_statuses (e.g. 503 from a saturated
+    hashing pool) are counted as errors and left out of the latencies.
+    """
+    next_index = iter(range(count))
+    index_lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    results_lock = threading.Lock()
+
+    def worker():
+        conn = NoDelayHTTPConnection('127.0.0.1', port, timeout=60)
+        own_latencies = []
+        own_errors = 0
+
+        while True:
+            with index_lock:
+                i = next(next_index, None)
+            if i is None:
+                break
+
+            method, path, body, headers = make_request(i)
+            headers = dict(headers or {})
+            if body is not None:
+                body = json.dumps(body).encode('utf-8')
+                headers['Content-Type'] = 'application/json'
+
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                status = None
+            elapsed = time.perf_counter() - start
+
+            if status in ok_statuses:
+                own_latencies.append(elapsed)
+            else:
+                own_errors += 1
+
+        conn.close()
+        with results_lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, time.perf_counter() - start, errors[0])
@@ -0,0 +1,57 @@
+"""Micro-benchmarks of the user.py and auth.py functions, called directly."""
+import time
+from benchmarks.stats import summarize
+
+def bench(fn, iterations, setup=None):
+    """Call fn(i) iterations times, timing each call. setup(i), if given, runs
+    untimed before every call (e.g. to clear a cache)."""
+    latencies = []
+    start = time.perf_counter()
+
+    for i in range(iterations):
+        if setup:
+            setup(i)
+        call_start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - call_start)
+
+    return summarize(latencies, time.perf_counter() - start)
+
+def run(users, iterations):
+    import auth
+    import user
+
+    emails = users['emails']
+    ids = users['ids']
+    token = auth.create_token(emails[0], ["admin", "user"])
+
+    def clear_user_cache(_):
+        user.clear_cache()
+
+    def clear_token_cache(_):
+        auth.clear_token_cache()
+
+    def consume_page(_):
+        status, result = user.get_users(limit=100)
+        if status == 200:
+            for _ in result:
+                pass
+
+    def toggle_role(i):
+        if i % 2:
+            user.remove_role(ids[i // 2 % len(ids)], "bench")
+        else:
+            user.add_role(ids[i // 2 % len(ids)], "bench")
+
+    return {
+        "user.get_user (cached)": bench(lambda i: user.get_user(ids[i % len(ids)]), iterations),
+        "user.get_user (uncached)": bench(lambda i: user.get_user(ids[i % len(ids)]), iterations, clear_user_cache),
+        "user.get_user_by_email (cached)": bench(lambda i: user.get_user_by_email(emails[i % len(emails)]), iterations),
+        "user.get_user_by_email (uncached)": bench(lambda i: user.get_user_by_email(emails[i % len(emails)]), iterations, clear_user_cache),
+        "user.get_user_credentials": bench(lambda i: user.get_user_credentials(emails[i % len(emails)]), iterations),
+        "user.get_users (page of 100)": bench(consume_page, max(1, iterations // 10)),
+        "user.add_role / remove_role": bench(toggle_role, iterations),
+        "auth.create_token": bench(lambda i: auth.create_token(emails[i % len(emails)], ["user"]), iterations),
+        "auth.decode_token (cached)": bench(lambda i: auth.decode_token(token), iterations),
+        "auth.decode_token (uncached)": bench(lambda i: auth.decode_token(token), iterations, clear_token_cache)
+    }
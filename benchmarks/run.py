@@ -0,0 +1,201 @@
+"""Benchmark the login service against a temporary database.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run --users 10000 --requests 2000 --concurrency 16 --output results.json
+    python -m benchmarks.run --backend postgres --output results-postgres.json
+    python -m benchmarks.compare baseline.json results.json
+
+Seeds a fresh database (a temporary SQLite file, or with --backend postgres
+the tables of --database-url or a throwaway pgserver instance), serves the app on a free local port, measures
+throughput and p50/p90/p99 latency of the main routes, runs micro-benchmarks
+of the user.py and auth.py functions, and writes everything as JSON.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = ['login', 'refresh', 'register', 'users', 'add_remove_role', 'protected']
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='number of users to seed (default 1000)')
+    parser.add_argument('--roles', type=int, default=2, help='roles per seeded user (default 2)')
+    parser.add_argument('--requests', type=int, default=500, help='requests per HTTP scenario (default 500)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients per HTTP scenario (default 8)')
+    parser.add_argument('--iterations', type=int, default=2000, help='calls per micro-benchmark (default 2000)')
+    parser.add_argument('--bcrypt-rounds', type=int, default=None, help='bcrypt cost (default BCRYPT_ROUNDS or 12)')
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi', help='serving mode to benchmark (default wsgi)')
+    parser.add_argument('--backend', choices=['sqlite', 'sharded', 'postgres'], default='sqlite', help='storage backend (default sqlite)')
+    parser.add_argument('--database-url', default=None, help='PostgreSQL database for --backend postgres, which is emptied first (default: a throwaway server started with pgserver)')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes with --server asgi (default 1)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'comma-separated HTTP scenarios (default all: {",".join(SCENARIOS)})')
+    parser.add_argument('--no-http', action='store_true', help='skip the HTTP scenarios')
+    parser.add_argument('--no-micro', action='store_true', help='skip the micro-benchmarks')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results (default bench_results.json)')
+    return parser.parse_args(argv)
+
+def start_postgres(directory):
+    # pgserver ships PostgreSQL binaries as a Python package, for running the
+    # postgres backend without a database server installed
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("--backend postgres needs --database-url or the pgserver package (pip install pgserver)")
+
+    server = pgserver.get_server(os.path.join(directory, 'pgdata'), cleanup_mode='stop')
+    return server.get_uri()
+
+def reset_postgres(url):
+    import psycopg
+
+    with psycopg.connect(url, autocommit=True) as conn:
+        # Every table of storage/postgres.py MIGRATIONS; CASCADE also drops
+        # the foreign keys that point at users
+        conn.execute('DROP TABLE IF EXISTS refresh_tokens, revoked_tokens, outbox, outbox_pruned, roles, users, schema_version CASCADE')
+
+def configure_environment(args, directory):
+    # Must happen before the service modules are imported, as they read their
+    # configuration at import time
+    os.environ['DB_PATH'] = os.path.join(directory, 'users.db')
+    os.environ['STORAGE_BACKEND'] = args.backend
+    if args.backend == 'postgres':
+        url = args.database_url or start_postgres(directory)
+        reset_postgres(url)
+        os.environ['DATABASE_URL'] = url
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret-key-0123456789abcdef')
+    # Every benchmark login comes from one address and repeats accounts
+    os.environ.setdefault('LOGIN_IP_LIMIT', '0')
+    os.environ.setdefault('LOGIN_ACCOUNT_LIMIT', '0')
+    # Measure how far throughput goes, not where load shedding starts
+    os.environ.setdefault('CONCURRENCY_LIMITING', 'off')
+    # Keep access and audit logs out of the results printed to stdout
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if args.bcrypt_rounds is not None:
+        os.environ['BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+
+def seed(count, roles_per_user):
+    """Insert count users sharing one password hash, with their roles.
+    Returns their emails and ids, and the plain password."""
+    import hashing
+    import user
+
+    password = 'benchmark-password'
+    hashed = hashing.hash_password(password)
+    extra_roles = [f'role{i}' for i in range(max(0, roles_per_user - 1))]
+
+    emails = []
+    ids = []
+    for start in range(0, count, 5000):
+        batch = [
+            {'email': f'user{i:07d}@bench.test', 'password': hashed, 'roles': ['user'] + extra_roles}
+            for i in range(start, min(count, start + 5000))
+        ]
+        status, results = user.register_users(batch)
+        if status != 200:
+            raise RuntimeError(f"Seeding failed: {results}")
+        emails.extend(result['email'] for result in results)
+        ids.extend(result['id'] for result in results)
+
+    user.add_role(ids[0], 'admin')
+    return {'emails': emails, 'ids': ids, 'password': password}
+
+def issue_refresh_tokens(users, count):
+    """One refresh token per request of the refresh scenario, as each can only
+    be used once."""
+    import refresh
+
+    tokens = []
+    for i in range(count):
+        status, token = refresh.issue(users['ids'][i % len(users['ids'])])
+        if status != 201:
+            raise RuntimeError(f"Issuing refresh tokens failed: {token}")
+        tokens.append(token)
+    return tokens
+
+def http_scenarios(users, admin_token, refresh_tokens):
+    emails = users['emails']
+    ids = users['ids']
+    password = users['password']
+    admin = {'Authorization': admin_token}
+    run_id = int(time.time())
+
+    return {
+        'login': lambda i: ('POST', '/login', {'email': emails[i % len(emails)], 'password': password}, None),
+        'refresh': lambda i: ('POST', '/token/refresh', {'refresh_token': refresh_tokens[i]}, None),
+        'register': lambda i: ('POST', '/register', {'email': f'new{run_id}-{i}@bench.test', 'password': password}, None),
+        'users': lambda i: ('GET', f'/users?limit=100&after_id={ids[(i * 100) % len(ids)] - 1}', None, admin),
+        'add_remove_role': lambda i: (
+            'PATCH',
+            f'/users/{ids[i // 2 % len(ids)]}/' + ('remove-role' if i % 2 else 'add-role'),
+            {'remove_role': 'bench'} if i % 2 else {'new_role': 'bench'},
+            admin
+        ),
+        'protected': lambda i: ('GET', '/stats', None, admin)
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='login-bench-') as directory:
+        configure_environment(args, directory)
+
+        import auth
+        import hashing
+        from benchmarks import http_bench, micro_bench
+
+        results = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'parameters': vars(args) | {'bcrypt_rounds': hashing.BCRYPT_ROUNDS}
+            },
+            'http': {},
+            'micro': {}
+        }
+
+        print(f"Seeding {args.users} users...", file=sys.stderr)
+        users = seed(args.users, args.roles)
+        admin_token = auth.create_token(users['emails'][0], ['admin', 'user'])
+
+        if not args.no_http:
+            server = http_bench.Server(args.server, args.workers).start()
+            try:
+                refresh_tokens = issue_refresh_tokens(users, args.requests) if 'refresh' in args.scenarios.split(',') else []
+                scenarios = http_scenarios(users, admin_token, refresh_tokens)
+                for name in args.scenarios.split(','):
+                    print(f"HTTP {name}...", file=sys.stderr)
+                    results['http'][name] = http_bench.run_scenario(server.port, scenarios[name], args.requests, args.concurrency)
+            finally:
+                server.stop()
+
+        if not args.no_micro:
+            print("Micro-benchmarks...", file=sys.stderr)
+            results['micro'] = micro_bench.run(users, args.iterations)
+
+        hashing.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for group in ('http', 'micro'):
+        for name, summary in results[group].items():
+            print(f"{group:5} {name:36} {summary['throughput'] or 0:>10.1f}/s  p50 {summary['p50_ms']:>9.3f} ms  p99 {summary['p99_ms']:>9.3f} ms  errors {summary['errors']}")
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
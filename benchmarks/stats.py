@@ -0,0 +1,27 @@
+import statistics
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies, seconds, errors=0):
+    """Throughput and latency percentiles (in milliseconds) for one benchmark."""
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000, 4) if value is not None else None
+
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 4),
+        "throughput": round(len(latencies) / seconds, 2) if seconds > 0 else None,
+        "mean_ms": ms(statistics.fmean(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p90_ms": ms(percentile(latencies, 0.90)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1]) if latencies else None
+    }
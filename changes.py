@@ -0,0 +1,150 @@
+"""Incremental feed of user and role changes, read from the outbox table.
+
+Every write to users and roles adds a row per changed user to the outbox in
+the same transaction (see storage.base.UnitOfWork), carrying the user's
+state afterwards: a consumer keeps a replica by applying the rows in order,
+and can apply one twice without harm. The outbox id is the feed's cursor
+(with the sharded backend, one outbox id per shard).
+
+GET /changes?since=<cursor> returns the rows after the cursor. With wait=<s>
+an empty answer is held back until a change arrives or the seconds pass.
+Commits made by this process wake waiting readers straight away; those made
+by other processes are found by querying again every CHANGES_POLL_INTERVAL
+seconds.
+
+Rows older than OUTBOX_RETENTION seconds are deleted. A consumer whose cursor
+is older than what is left gets 410 Gone, with the current cursor to carry
+on from after reloading users from GET /users.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import storage
+
+# Load environment variables from .env file
+load_dotenv()
+CHANGES_PAGE_LIMIT = int(os.getenv('CHANGES_PAGE_LIMIT', 1000))
+CHANGES_MAX_WAIT = int(os.getenv('CHANGES_MAX_WAIT', 30))
+CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', 1))
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', 7 * 24 * 3600))
+# Seconds between deletions of rows older than OUTBOX_RETENTION
+OUTBOX_PRUNE_INTERVAL = 3600
+
+# Bumped by notify() after each commit that wrote outbox rows, so waiting
+# readers know to query again
+_version = 0
+_condition = threading.Condition()
+_listeners = []
+# Pruning runs on its own thread, so the write request that happens to be
+# due for it does not wait on the DELETE
+_prune_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox-prune')
+_prune_lock = threading.Lock()
+_next_prune = 0.0
+
+def notify():
+    """Wake the readers waiting for changes. Called after a commit that wrote to the outbox."""
+    global _version
+
+    with _condition:
+        _version += 1
+        _condition.notify_all()
+
+    for listener in _listeners:
+        listener()
+
+    _schedule_prune()
+
+def subscribe(listener):
+    """Call listener(), from the committing thread, after every notify()."""
+    _listeners.append(listener)
+
+def wait(seen, timeout):
+    """Block until notify() is called after _version was seen, or timeout seconds pass."""
+    with _condition:
+        _condition.wait_for(lambda: _version != seen, timeout)
+
+def _schedule_prune():
+    global _next_prune
+
+    with _prune_lock:
+        if time.monotonic() < _next_prune:
+            return
+        _next_prune = time.monotonic() + OUTBOX_PRUNE_INTERVAL
+
+    _prune_executor.submit(_prune)
+
+def _prune():
+    global _next_prune
+
+    backend = storage.get_backend()
+
+    try:
+        backend.prune_changes(int(time.time()) - OUTBOX_RETENTION)
+
+    # Tried again after the next commit
+    except backend.Error:
+        with _prune_lock:
+            _next_prune = 0.0
+
+def _int(args, name, default, minimum=0, maximum=None):
+    value = args.get(name)
+
+    if value is None or value == '':
+        return default
+
+    if not value.isdigit() or int(value) < minimum or (maximum is not None and int(value) > maximum):
+        limits = f"between {minimum} and {maximum}" if maximum is not None else f"at least {minimum}"
+        raise ValueError(f"'{name}' must be an integer {limits}")
+
+    return int(value)
+
+def parse_query(args):
+    """(since, limit, wait) from the query arguments of GET /changes. Raises ValueError."""
+    try:
+        since = storage.get_backend().parse_cursor(args.get('since'))
+    except ValueError:
+        raise ValueError("'since' must be a cursor returned by GET /changes, or 0")
+
+    return (
+        since,
+        _int(args, 'limit', CHANGES_PAGE_LIMIT, minimum=1, maximum=CHANGES_PAGE_LIMIT),
+        _int(args, 'wait', 0, maximum=CHANGES_MAX_WAIT)
+    )
+
+def read(since, limit):
+    """The changes after the cursor since, without waiting."""
+    backend = storage.get_backend()
+
+    try:
+        rows, latest = backend.read_changes(since, limit)
+
+        if rows is None:
+            return [410, {
+                "error": "Changes after this cursor were deleted. Reload users from GET /users, then read changes from the cursor given.",
+                "cursor": backend.format_cursor(latest)
+            }]
+
+        return [200, {
+            "changes": rows,
+            "cursor": rows[-1]['cursor'] if rows else backend.format_cursor(since)
+        }]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def poll(since, limit, wait_seconds=0):
+    """The changes after the cursor since, waiting up to wait_seconds for one
+    if there are none yet. Holds the calling thread while it waits."""
+    deadline = time.monotonic() + wait_seconds
+
+    while True:
+        seen = _version
+        status, result = read(since, limit)
+        remaining = deadline - time.monotonic()
+
+        if status != 200 or result['changes'] or remaining <= 0:
+            return [status, result]
+
+        wait(seen, min(remaining, CHANGES_POLL_INTERVAL))
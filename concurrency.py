@@ -0,0 +1,177 @@
+"""Adaptive limits on the requests in progress, per class of route.
+
+Each class has a limit on its requests in flight in this process; a request
+over it is refused at once with 503 and Retry-After, instead of waiting in
+line behind requests that are already too slow. The classes keep each other
+from starving:
+
+- 'auth': login, registration, token refresh and logout - bcrypt and writes
+- 'probe': health and readiness checks, metrics, the service description
+  and the public keys, so probes still answer while the service is loaded
+- 'admin': everything else, except GET /changes: its long polls wait idle,
+  and would otherwise hold slots the whole time
+
+Limits adapt to latency (additive increase, multiplicative decrease). Only
+requests that ended while at least half the limit was in use count, so a
+lone slow request (a large export) is not taken for overload. While they
+finish within the class's target latency, the limit grows by about one per
+limit's worth of requests; when one is slower than the target, or any is
+turned away by the hashing pool, it shrinks by CONCURRENCY_BACKOFF, at most
+once per target latency. Limits stay between
+CONCURRENCY_LIMIT_MIN and the class's maximum, which is also where they start.
+
+readiness() is the check behind GET /ready: whether this process should be
+sent more requests, judged by the database's latency and how much of the
+limits and the hashing pool is in use.
+"""
+import os
+import threading
+import time
+from dotenv import load_dotenv
+import hashing
+import metrics
+import storage
+
+# Load environment variables from .env file
+load_dotenv()
+# 'off' admits every request, e.g. for benchmarks of raw throughput
+CONCURRENCY_LIMITING = os.getenv('CONCURRENCY_LIMITING', 'on')
+CONCURRENCY_LIMIT_MIN = int(os.getenv('CONCURRENCY_LIMIT_MIN', 2))
+CONCURRENCY_BACKOFF = float(os.getenv('CONCURRENCY_BACKOFF', 0.8))
+# Largest limit of each class, per worker process
+CONCURRENCY_LIMIT_AUTH = int(os.getenv('CONCURRENCY_LIMIT_AUTH', 64))
+CONCURRENCY_LIMIT_ADMIN = int(os.getenv('CONCURRENCY_LIMIT_ADMIN', 32))
+CONCURRENCY_LIMIT_PROBE = int(os.getenv('CONCURRENCY_LIMIT_PROBE', 32))
+# Seconds a request of each class may take before its limit shrinks
+LATENCY_TARGET_AUTH = float(os.getenv('LATENCY_TARGET_AUTH', 1.0))
+LATENCY_TARGET_ADMIN = float(os.getenv('LATENCY_TARGET_ADMIN', 0.5))
+LATENCY_TARGET_PROBE = float(os.getenv('LATENCY_TARGET_PROBE', 0.1))
+# GET /ready answers 503 when a database ping takes longer than this many
+# seconds, or this fraction of a limit or of the hashing pool is in use
+READY_DB_LATENCY = float(os.getenv('READY_DB_LATENCY', 0.25))
+READY_SATURATION = float(os.getenv('READY_SATURATION', 0.9))
+
+AUTH_PATHS = frozenset(['/login', '/register', '/token/refresh', '/logout'])
+PROBE_PATHS = frozenset(['/', '/health', '/ready', '/metrics', '/.well-known/jwks.json', '/apispec.json'])
+UNLIMITED_PATHS = frozenset(['/changes'])
+
+SHED = metrics.Counter('requests_shed_total', 'Requests refused because their route class was at its concurrency limit', ['class'])
+
+class Overloaded(Exception):
+    """Raised when a route class is at its limit; retry_after is in seconds."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdaptiveLimit:
+    """A limit on requests in flight that follows their latency, see the module docstring."""
+
+    def __init__(self, name, maximum, target, minimum=CONCURRENCY_LIMIT_MIN):
+        self.name = name
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.target = target
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._next_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Count a request in, or raise Overloaded if the class is at its limit."""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                SHED.inc(self.name)
+                raise Overloaded("The service is overloaded, please try again shortly")
+
+            self.in_flight += 1
+
+    def release(self, seconds, overloaded=False):
+        """Count a request out after `seconds`; overloaded if it failed for
+        lack of capacity further in."""
+        with self._lock:
+            used = self.in_flight
+            self.in_flight -= 1
+            busy = used * 2 >= self.limit
+
+            if overloaded or (busy and seconds > self.target):
+                now = time.monotonic()
+                if now >= self._next_decrease:
+                    self.limit = max(self.minimum, self.limit * CONCURRENCY_BACKOFF)
+                    self._next_decrease = now + self.target
+
+            elif busy:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def saturation(self):
+        """The fraction of the current limit in use."""
+        return self.in_flight / max(1, int(self.limit))
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "limit": int(self.limit),
+            "maximum": self.maximum
+        }
+
+LIMITS = {
+    'auth': AdaptiveLimit('auth', CONCURRENCY_LIMIT_AUTH, LATENCY_TARGET_AUTH),
+    'admin': AdaptiveLimit('admin', CONCURRENCY_LIMIT_ADMIN, LATENCY_TARGET_ADMIN),
+    'probe': AdaptiveLimit('probe', CONCURRENCY_LIMIT_PROBE, LATENCY_TARGET_PROBE)
+}
+
+def route_class(path):
+    if path in AUTH_PATHS:
+        return 'auth'
+    if path in PROBE_PATHS:
+        return 'probe'
+    return 'admin'
+
+def acquire(path):
+    """Count a request to path in. Returns its limit, to release() when the
+    request ends, or None if it is not limited. Raises Overloaded."""
+    if CONCURRENCY_LIMITING != 'on' or path in UNLIMITED_PATHS:
+        return None
+
+    limit = LIMITS[route_class(path)]
+    limit.acquire()
+    return limit
+
+def stats():
+    return {name: limit.stats() for name, limit in LIMITS.items()}
+
+# ----------------------------------------------------- Readiness
+def readiness():
+    """[200 or 503, result]: whether this process is ready for more requests,
+    with the checks that decided it."""
+    checks = {}
+    backend = storage.get_backend()
+    start = time.perf_counter()
+
+    try:
+        backend.ping()
+        seconds = time.perf_counter() - start
+        checks['database'] = {"ok": seconds <= READY_DB_LATENCY, "latency_ms": round(seconds * 1000, 3)}
+    except backend.Error as e:
+        checks['database'] = {"ok": False, "error": str(e)}
+
+    # Probes have a limit of their own, and are not what overloads a process
+    for name in ('auth', 'admin'):
+        saturation = LIMITS[name].saturation()
+        checks[f'{name}_requests'] = {"ok": saturation < READY_SATURATION, "saturation": round(saturation, 3), **LIMITS[name].stats()}
+
+    saturation = hashing.saturation()
+    checks['hashing'] = {"ok": saturation < READY_SATURATION, "saturation": round(saturation, 3)}
+
+    ready = all(check['ok'] for check in checks.values())
+    return [200 if ready else 503, {"status": "ready" if ready else "not ready", "checks": checks}]
+
+metrics.add_collector(lambda: metrics.gauge_lines(
+    'concurrency_limit', 'Current concurrency limit of each route class',
+    {(name,): int(limit.limit) for name, limit in LIMITS.items()},
+    ['class']
+) + metrics.gauge_lines(
+    'requests_in_flight', 'Requests in progress in each route class',
+    {(name,): limit.in_flight for name, limit in LIMITS.items()},
+    ['class']
+))
@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+import os
+from dotenv import load_dotenv
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+DB_PATH = os.getenv('DB_PATH', "users.db")
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 5))
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', 256))
+
+# One connection per (thread, database file). sqlite3 connections must not be
+# shared between threads, but can be reused for every query a thread runs.
+# A thread's connections are closed when the thread exits and its locals are
+# garbage collected.
+_local = threading.local()
+
+def _operation(sql):
+    # First keyword of the statement (SELECT, INSERT, ...) as the metric label
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording each query's time, including lock waits, as the 'db' stage."""
+
+    def execute(self, sql, parameters=()):
+        with metrics.timed('db', _operation(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with metrics.timed('db', _operation(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def _open(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        factory=TimedConnection
+    )
+    conn.row_factory = sqlite3.Row
+
+    # WAL lets readers run alongside the single writer, and with
+    # synchronous=NORMAL a commit no longer waits for an fsync
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+    conn.execute('PRAGMA foreign_keys=ON')
+
+    return conn
+
+def get_connection(path=None):
+    """Return this thread's connection to the database at path (default DB_PATH).
+
+    Use it as a context manager (`with get_connection() as conn:`) to commit on
+    success and roll back on error - the connection itself stays open.
+    """
+    path = path or DB_PATH
+    connections = getattr(_local, 'connections', None)
+
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = _open(path)
+
+    return conn
+
+def close_connection(path=None):
+    """Close this thread's connection to path, if any."""
+    connections = getattr(_local, 'connections', {})
+    conn = connections.pop(path or DB_PATH, None)
+
+    if conn is not None:
+        conn.close()
@@ -0,0 +1,102 @@
+"""Swagger UI (/docs) and OpenAPI spec (/apispec.json) for the app.
+
+flasgger and its dependencies (jsonschema, PyYAML, mistune) are slow to
+import, and Flask does not allow adding its blueprint once requests are being
+served. So the docs live in a separate Flask app, put in front of the service
+by ApiDocs.wsgi_app, which imports flasgger and builds the spec from the
+service's routes on first use (SWAGGER_MODE=lazy), at startup (eager), or
+never (off).
+"""
+import os
+import threading
+import time
+from flask import Flask, g, request
+from dotenv import load_dotenv
+import logs
+import metrics
+from precomputed import PrecomputedResponse
+
+# Load environment variables from .env file
+load_dotenv()
+SWAGGER_MODE = os.getenv('SWAGGER_MODE', 'lazy')
+
+# Paths served by the docs app: the Swagger UI, its assets and the spec
+DOCS_PATHS = ('/docs', '/apidocs/', '/flasgger_static/', '/oauth2-redirect.html', '/apispec.json')
+
+def swag_from(specs):
+    """Attach a swagger/*.yaml file to a view, like flasgger.swag_from with a
+    file path, without importing flasgger."""
+    def decorator(function):
+        if not specs.startswith('/'):
+            function.root_path = os.path.dirname(os.path.abspath(function.__globals__['__file__']))
+        function.swag_path = os.path.join(getattr(function, 'root_path', ''), specs)
+        function.swag_type = specs.rsplit('.', 1)[-1]
+        return function
+    return decorator
+
+class ApiDocs:
+    def __init__(self, app, mode=SWAGGER_MODE):
+        if mode not in ('eager', 'lazy', 'off'):
+            raise ValueError(f"Unknown SWAGGER_MODE '{mode}', expected 'eager', 'lazy' or 'off'")
+
+        self.app = app
+        self.mode = mode
+        self.spec = None
+        self._docs_app = None
+        self._lock = threading.Lock()
+
+        if mode == 'eager':
+            self._build()
+
+    def _build(self):
+        with self._lock:
+            if self._docs_app is None:
+                from swagger.config import init_swagger
+
+                docs_app = Flask(__name__)
+                swagger = init_swagger(docs_app)
+
+                # The spec describes the service's routes, found through current_app
+                with self.app.app_context():
+                    self.spec = PrecomputedResponse(self.app.json.dumps(swagger.get_apispecs('apispec')))
+
+                docs_app.view_functions['flasgger.apispec'] = self.spec.response
+
+                @docs_app.before_request
+                def start_timer():
+                    g.request_start = time.perf_counter()
+
+                @docs_app.after_request
+                def record_request(response):
+                    route = request.url_rule.rule if request.url_rule else 'unmatched'
+                    seconds = time.perf_counter() - g.request_start
+                    metrics.observe_request(request.method, route, response.status_code, seconds)
+                    logs.access(request.method, request.path, route, response.status_code, seconds, request.remote_addr)
+                    return response
+
+                self._docs_app = docs_app
+
+        return self._docs_app
+
+    def apispec(self):
+        """The encoded spec, built on first use. None if SWAGGER_MODE is off."""
+        if self.mode == 'off':
+            return None
+
+        self._build()
+        return self.spec
+
+    def wsgi_app(self, wsgi_app):
+        """Wrap the service's WSGI callable to send DOCS_PATHS to the docs app."""
+        if self.mode == 'off':
+            return wsgi_app
+
+        def dispatch(environ, start_response):
+            if environ.get('PATH_INFO', '').startswith(DOCS_PATHS):
+                docs_app = self._build()
+                if docs_app.url_map.bind_to_environ(environ).test():
+                    return docs_app.wsgi_app(environ, start_response)
+
+            return wsgi_app(environ, start_response)
+
+        return dispatch
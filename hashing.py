@@ -0,0 +1,210 @@
+import bcrypt
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dotenv import load_dotenv
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+HASH_EXECUTOR = os.getenv('HASH_EXECUTOR', 'process')
+# Per worker process: each of the WEB_CONCURRENCY uvicorn workers has its own
+# pool, so by default they share the machine's CPUs between them
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', max(1, (os.cpu_count() or 1) // int(os.getenv('WEB_CONCURRENCY', 1)))))
+HASH_QUEUE_SIZE = int(os.getenv('HASH_QUEUE_SIZE', HASH_WORKERS * 4))
+HASH_TIMEOUT = float(os.getenv('HASH_TIMEOUT', 10))
+# Slots a bulk import may hold at once, so logins still find free slots
+HASH_BULK_SLOTS = int(os.getenv('HASH_BULK_SLOTS', max(1, HASH_QUEUE_SIZE // 2)))
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool is saturated and cannot take more work."""
+
+_executor = None
+_executor_lock = threading.Lock()
+# Jobs running or waiting in the pool; a request that cannot get a slot is
+# rejected straight away instead of queueing behind everyone else
+_slots = threading.BoundedSemaphore(HASH_QUEUE_SIZE)
+_in_use = 0
+_in_use_lock = threading.Lock()
+REJECTIONS = metrics.Counter('hashing_rejections_total', 'Password operations rejected because the pool was saturated')
+_bulk_slots = threading.BoundedSemaphore(HASH_BULK_SLOTS)
+# Hash of a random secret at the current cost, checked in place of the
+# password of an unknown user (see submit_check)
+_dummy_hash = None
+_dummy_hash_lock = threading.Lock()
+# bcrypt variant written by bcrypt.gensalt; hashes with another one ($2a$,
+# $2y$) are upgraded on login along with outdated costs
+BCRYPT_PREFIX = '2b'
+
+# ----------------------------------------------------- Worker functions
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+def _noop():
+    return None
+
+# ----------------------------------------------------- Slots
+def _acquire_slot(timeout=None):
+    global _in_use
+
+    acquired = _slots.acquire(timeout=timeout) if timeout is not None else _slots.acquire(blocking=False)
+
+    if acquired:
+        with _in_use_lock:
+            _in_use += 1
+
+    return acquired
+
+def _release_slot():
+    global _in_use
+
+    with _in_use_lock:
+        _in_use -= 1
+
+    _slots.release()
+
+def saturation():
+    """The fraction of the HASH_QUEUE_SIZE slots in use, for the readiness check."""
+    return _in_use / HASH_QUEUE_SIZE
+
+# ----------------------------------------------------- Executor
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                if HASH_EXECUTOR == 'thread':
+                    _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hashing')
+                else:
+                    _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+
+    return _executor
+
+def start():
+    """Create the pool and its workers now rather than on the first login.
+
+    Call this at startup, before the server starts its request threads, so
+    worker processes are not forked from a busy multi-threaded process. The
+    dummy hash for unknown users is made here too, not by the first one.
+    """
+    _get_executor().submit(_noop).result()
+    _get_dummy_hash()
+
+def shutdown():
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def _submit(fn, *args):
+    if not _acquire_slot():
+        REJECTIONS.inc()
+        raise HashingBusy("Too many password operations in progress, please try again shortly")
+
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        _release_slot()
+        raise
+
+    future.add_done_callback(lambda _: _release_slot())
+    return future
+
+def _result(future):
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except TimeoutError:
+        raise HashingBusy("Password operation timed out, please try again shortly")
+
+# ----------------------------------------------------- Public functions
+def submit_hash(password):
+    """Start hashing password (str) in the pool and return the future."""
+    return _submit(_hash, password.encode('utf-8'), BCRYPT_ROUNDS)
+
+def _get_dummy_hash():
+    global _dummy_hash
+
+    if _dummy_hash is None:
+        with _dummy_hash_lock:
+            if _dummy_hash is None:
+                _dummy_hash = bcrypt.hashpw(secrets.token_bytes(16), bcrypt.gensalt(BCRYPT_ROUNDS))
+
+    return _dummy_hash
+
+def submit_check(password, hashed):
+    """Start checking password (str) against a stored hash and return the future.
+
+    With hashed None (no such user) the password is checked against a dummy
+    hash instead, which fails as slowly as a wrong password for a real user,
+    so the response time does not tell whether the account exists.
+    """
+    if hashed is None:
+        hashed = _get_dummy_hash()
+
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+
+    return _submit(_check, password.encode('utf-8'), hashed)
+
+def needs_rehash(hashed):
+    """Whether a stored hash uses another bcrypt variant or cost than BCRYPT_ROUNDS."""
+    if isinstance(hashed, (bytes, bytearray, memoryview)):
+        hashed = bytes(hashed).decode('ascii', 'replace')
+
+    # $<variant>$<cost>$<salt and hash>
+    parts = hashed.split('$')
+    return len(parts) != 4 or parts[1] != BCRYPT_PREFIX or parts[2] != f'{BCRYPT_ROUNDS:02d}'
+
+def hash_password(password):
+    with metrics.timed('bcrypt', 'hash'):
+        return _result(submit_hash(password))
+
+def check_password(password, hashed):
+    with metrics.timed('bcrypt', 'check'):
+        return _result(submit_check(password, hashed))
+
+def hash_passwords(passwords):
+    """Hash many passwords in parallel, returning the hashes in the same order.
+
+    Unlike single operations this waits for free slots instead of failing, but
+    never holds more than HASH_BULK_SLOTS of them.
+    """
+    with metrics.timed('bcrypt', 'hash_many'):
+        return _hash_passwords(passwords)
+
+def _hash_passwords(passwords):
+    futures = []
+
+    try:
+        for password in passwords:
+            if not _bulk_slots.acquire(timeout=HASH_TIMEOUT):
+                raise HashingBusy("Password hashing pool is busy, please try again shortly")
+
+            if not _acquire_slot(timeout=HASH_TIMEOUT):
+                _bulk_slots.release()
+                raise HashingBusy("Password hashing pool is busy, please try again shortly")
+
+            try:
+                future = _get_executor().submit(_hash, password.encode('utf-8'), BCRYPT_ROUNDS)
+            except Exception:
+                _release_slot()
+                _bulk_slots.release()
+                raise
+
+            future.add_done_callback(lambda _: (_release_slot(), _bulk_slots.release()))
+            futures.append(future)
+
+        return [_result(future) for future in futures]
+
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
@@ -0,0 +1,122 @@
+"""Structured JSON logs, written off the request path.
+
+Log calls only put the record on a queue; a background thread (a
+logging.handlers.QueueListener) formats each record as one JSON line and
+writes it to stdout. If the writer falls LOG_QUEUE_SIZE records behind, new
+records are dropped and counted instead of making requests wait on stdout.
+
+Two loggers carry the service's own events:
+
+- 'access': one line per request, from access(). Successful requests to the
+  routes in ACCESS_LOG_SAMPLED_ROUTES (polled by probes and scrapers) are
+  logged at the rate ACCESS_LOG_SAMPLE_RATE; errors are always logged.
+- 'audit': who did what, from audit(): registrations, logins, role changes,
+  user updates and deletes. Never sampled.
+"""
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from dotenv import load_dotenv
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv('ACCESS_LOG_SAMPLE_RATE', 0.01))
+ACCESS_LOG_SAMPLED_ROUTES = frozenset(
+    route.strip() for route in os.getenv('ACCESS_LOG_SAMPLED_ROUTES', '/,/health,/metrics,/.well-known/jwks.json').split(',') if route.strip()
+)
+
+access_logger = logging.getLogger('access')
+audit_logger = logging.getLogger('audit')
+
+DROPPED = metrics.Counter('log_records_dropped_total', 'Log records dropped because the log writer fell behind')
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with the fields passed as extra={'fields': {...}}."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records when the queue is full instead of blocking."""
+
+    def prepare(self, record):
+        # Like QueueHandler.prepare, but keeps a traceback out of the message,
+        # for the writer to put in a field of its own
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+_listener = None
+
+def configure():
+    """Send every log record through the queue to the JSON writer. Safe to call more than once."""
+    global _listener
+
+    if _listener is not None:
+        return
+
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [DroppingQueueHandler(records)]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(records, writer, respect_handler_level=True)
+    _listener.start()
+    # Write what is still queued when the process exits
+    atexit.register(_listener.stop)
+
+def access(method, path, route, status, seconds, client=None):
+    if status < 400 and route in ACCESS_LOG_SAMPLED_ROUTES and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return
+
+    if access_logger.isEnabledFor(logging.INFO):
+        access_logger.info(f'{method} {path} {status}', extra={'fields': {
+            'method': method,
+            'path': path,
+            'route': route,
+            'status': status,
+            'duration_ms': round(seconds * 1000, 3),
+            'client': client
+        }})
+
+def audit(event, **fields):
+    """Record an audit event, e.g. audit('user.deleted', actor=..., user_id=...)."""
+    audit_logger.info(event, extra={'fields': {'event': event, **fields}})
@@ -0,0 +1,122 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Default latency buckets in seconds, from sub-millisecond queries up to slow
+# bcrypt work waiting behind a full pool
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+_collectors = []
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labelvalues -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            data = self._values.get(labelvalues)
+            if data is None:
+                data = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labelvalues, data in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, data):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labelvalues, [("le", _format_value(bound))])} {cumulative}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labelvalues, [("le", "+Inf")])} {data[-1]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {data[-2]!r}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, labelvalues)} {data[-1]}')
+        return lines
+
+def add_collector(collector):
+    """Register a function called on every scrape that returns extra lines,
+    for values that already live elsewhere (e.g. cache counters)."""
+    _collectors.append(collector)
+
+def gauge_lines(name, documentation, samples, labelnames=()):
+    """Render samples ({labelvalues: value}) as a gauge, for collectors."""
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} gauge']
+    for labelvalues, value in sorted(samples.items()):
+        lines.append(f'{name}{_format_labels(labelnames, labelvalues)} {_format_value(value)}')
+    return lines
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+# ----------------------------------------------------- Metrics
+REQUESTS = Counter('http_requests_total', 'HTTP requests handled', ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time to handle an HTTP request', ['method', 'route'])
+ERRORS = Counter('http_errors_total', 'HTTP responses with a 4xx or 5xx status', ['status'])
+STAGE_LATENCY = Histogram('stage_duration_seconds', 'Time spent in each stage of a request', ['stage', 'operation'])
+
+def observe_request(method, route, status, seconds):
+    REQUESTS.inc(method, route, str(status))
+    REQUEST_LATENCY.observe(seconds, method, route)
+    if status >= 400:
+        ERRORS.inc(str(status))
+
+@contextmanager
+def timed(stage, operation):
+    """Record the time spent in the block as one stage of the request:
+    'db', 'bcrypt', 'jwt' or 'serialization'."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage, operation)
@@ -0,0 +1,156 @@
+import sqlite3
+import db
+
+USERS_TABLE = "users"
+ROLES_TABLE = "roles"
+REVOKED_TOKENS_TABLE = "revoked_tokens"
+REFRESH_TOKENS_TABLE = "refresh_tokens"
+OUTBOX_TABLE = "outbox"
+OUTBOX_PRUNED_TABLE = "outbox_pruned"
+
+# Schema migrations, applied in order. The database's PRAGMA user_version is
+# the number of migrations already applied. Never edit a released migration -
+# append a new one instead.
+MIGRATIONS = [
+    # 1: the original tables
+    [
+        f'''CREATE TABLE IF NOT EXISTS {USERS_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        )''',
+        f'''CREATE TABLE IF NOT EXISTS {ROLES_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES {USERS_TABLE} (id),
+            UNIQUE (user_id, role)
+        )'''
+    ],
+    # 2: STRICT tables with the bcrypt hash stored as a BLOB, roles keyed by
+    # (user_id, role) without a rowid and deleted along with their user, and
+    # an index for finding the users that have a role
+    [
+        f'''CREATE TABLE {USERS_TABLE}_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL UNIQUE,
+            password BLOB NOT NULL
+        ) STRICT''',
+        f'''INSERT INTO {USERS_TABLE}_new (id, email, password)
+            SELECT id, email, CAST(password AS BLOB) FROM {USERS_TABLE}''',
+        # Keep the id sequence, so ids of deleted users are not handed out again
+        f"DELETE FROM sqlite_sequence WHERE name = '{USERS_TABLE}_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = '{USERS_TABLE}')",
+        f"INSERT INTO sqlite_sequence (name, seq) SELECT '{USERS_TABLE}_new', seq FROM sqlite_sequence WHERE name = '{USERS_TABLE}'",
+        f'''CREATE TABLE {ROLES_TABLE}_new (
+            user_id INTEGER NOT NULL REFERENCES {USERS_TABLE} (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            PRIMARY KEY (user_id, role)
+        ) STRICT, WITHOUT ROWID''',
+        # Roles left behind by deleted users are dropped
+        f'''INSERT OR IGNORE INTO {ROLES_TABLE}_new (user_id, role)
+            SELECT user_id, role FROM {ROLES_TABLE}
+            WHERE user_id IN (SELECT id FROM {USERS_TABLE})''',
+        f'DROP TABLE {ROLES_TABLE}',
+        f'DROP TABLE {USERS_TABLE}',
+        f'ALTER TABLE {USERS_TABLE}_new RENAME TO {USERS_TABLE}',
+        f'ALTER TABLE {ROLES_TABLE}_new RENAME TO {ROLES_TABLE}',
+        f'CREATE INDEX {ROLES_TABLE}_role_idx ON {ROLES_TABLE} (role, user_id)'
+    ],
+    # 3: ids (jti claims) of tokens revoked before they expire. AUTOINCREMENT
+    # ids only grow, so other processes can fetch what is new since their
+    # last sync
+    [
+        f'''CREATE TABLE {REVOKED_TOKENS_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            jti TEXT NOT NULL UNIQUE,
+            expires_at INTEGER NOT NULL
+        ) STRICT''',
+        f'CREATE INDEX {REVOKED_TOKENS_TABLE}_expires_idx ON {REVOKED_TOKENS_TABLE} (expires_at)'
+    ],
+    # 4: refresh tokens, by SHA-256 digest. Each refresh replaces the token
+    # with a new one of the same family and keeps the old one marked as used
+    [
+        f'''CREATE TABLE {REFRESH_TOKENS_TABLE} (
+            token_hash BLOB PRIMARY KEY,
+            family BLOB NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES {USERS_TABLE} (id) ON DELETE CASCADE,
+            expires_at INTEGER NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0
+        ) STRICT, WITHOUT ROWID''',
+        f'CREATE INDEX {REFRESH_TOKENS_TABLE}_family_idx ON {REFRESH_TOKENS_TABLE} (family)',
+        f'CREATE INDEX {REFRESH_TOKENS_TABLE}_user_idx ON {REFRESH_TOKENS_TABLE} (user_id, expires_at)'
+    ],
+    # 5: the outbox - a row per user changed, written in the transaction
+    # that changed it, with the user's state afterwards as JSON (NULL once
+    # deleted). AUTOINCREMENT ids only grow, so they serve as the cursor of
+    # GET /changes
+    [
+        f'''CREATE TABLE {OUTBOX_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT,
+            created_at INTEGER NOT NULL
+        ) STRICT''',
+        f'CREATE INDEX {OUTBOX_TABLE}_created_idx ON {OUTBOX_TABLE} (created_at)'
+    ],
+    # 6: the highest outbox id deleted by pruning, so GET /changes answers
+    # 410 only to cursors below it. Anything under the oldest row may have
+    # been pruned before this table existed.
+    [
+        f'''CREATE TABLE {OUTBOX_PRUNED_TABLE} (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            last_id INTEGER NOT NULL
+        ) STRICT''',
+        f'INSERT INTO {OUTBOX_PRUNED_TABLE} (id, last_id) SELECT 0, COALESCE(MIN(id) - 1, 0) FROM {OUTBOX_TABLE}'
+    ]
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(path=None):
+    """Bring the database at path (default DB_PATH) up to SCHEMA_VERSION.
+
+    Safe to call from several processes at once: migrations run under the
+    database write lock, and a process that finds the work done skips it.
+    Returns the schema version.
+    """
+    conn = sqlite3.connect(path or db.DB_PATH, timeout=db.DB_BUSY_TIMEOUT, isolation_level=None)
+
+    try:
+        if get_version(conn) == SCHEMA_VERSION:
+            return SCHEMA_VERSION
+
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Tables are rebuilt while they are referenced, so foreign keys are
+        # only checked once the whole migration has run
+        conn.execute('PRAGMA foreign_keys=OFF')
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            version = get_version(conn)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"Database schema version {version} is newer than this service ({SCHEMA_VERSION})")
+
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+
+            problems = conn.execute('PRAGMA foreign_key_check').fetchall()
+            if problems:
+                raise RuntimeError(f"Foreign key check failed after migration: {problems[:5]}")
+
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute('COMMIT')
+
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        return SCHEMA_VERSION
+
+    finally:
+        conn.close()
@@ -0,0 +1,32 @@
+import hashlib
+from flask import Response, request
+from werkzeug.http import parse_etags, quote_etag
+
+class PrecomputedResponse:
+    """A response body encoded once, at startup, and served as is.
+
+    Responses carry an ETag; a client sending it back in If-None-Match gets
+    an empty 304 Not Modified instead of the body.
+    """
+
+    def __init__(self, body, mimetype='application/json', cache_control='no-cache'):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.headers = [
+            ('content-type', mimetype),
+            ('etag', quote_etag(self.etag)),
+            # By default cached copies must be revalidated, which costs a 304
+            ('cache-control', cache_control)
+        ]
+
+    def not_modified(self, if_none_match):
+        """Whether an If-None-Match header value matches this body."""
+        return bool(if_none_match) and parse_etags(if_none_match).contains(self.etag)
+
+    def response(self):
+        """The Flask response to the current request: the body, or a 304."""
+        if self.not_modified(request.headers.get('If-None-Match')):
+            return Response(status=304, headers=self.headers[1:])
+
+        return Response(self.body, headers=self.headers)
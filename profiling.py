@@ -0,0 +1,229 @@
+"""Opt-in profiles of single requests, kept for download.
+
+A request is profiled when an admin sends the PROFILE_HEADER header, or at
+random at PROFILE_SAMPLE_RATE. Two profilers are available:
+
+- 'cprofile': every function call of the request thread, saved as a pstats
+  file (`python -m pstats`, snakeviz).
+- 'sampling': the request thread's stack every PROFILE_INTERVAL seconds, saved
+  as a speedscope file (https://www.speedscope.app) - a flame graph with less
+  overhead than cProfile.
+
+bcrypt runs in the hashing pool and shows up as time waiting on its future;
+queries (db.py, storage/) and jwt run in the request thread and show up in full.
+Profiles are written to PROFILE_DIR, shared by the worker processes, which
+keeps the last PROFILE_KEEP of them. One request per process is profiled at
+a time; others run unprofiled meanwhile.
+"""
+import cProfile
+import json
+import marshal
+import os
+import pstats
+import re
+import secrets
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+PROFILE_HEADER = os.getenv('PROFILE_HEADER', 'X-Profile')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'sampling')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.001))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+
+MODES = ('cprofile', 'sampling')
+# File name extension and download mimetype of each mode's profiles
+FORMATS = {
+    'cprofile': ('.prof', 'application/octet-stream'),
+    'sampling': ('.speedscope.json', 'application/json')
+}
+_ID = re.compile(r'^[0-9]{13}-[0-9a-f]{8}$')
+
+_active = threading.Lock()
+
+# ----------------------------------------------------- Profilers
+class CProfiler:
+    mode = 'cprofile'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self, name):
+        # The format pstats.Stats(path) reads, as written by Stats.dump_stats
+        stats = pstats.Stats(self._profile)
+        return marshal.dumps(stats.stats)
+
+class SamplingProfiler:
+    """Samples one thread's stack from a background thread."""
+
+    mode = 'sampling'
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.frames = []
+        self._frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._end = time.perf_counter()
+
+    def _frame(self, code):
+        key = (code.co_filename, code.co_name, code.co_firstlineno)
+        index = self._frame_index.get(key)
+
+        if index is None:
+            index = self._frame_index[key] = len(self.frames)
+            self.frames.append({'name': code.co_name, 'file': code.co_filename, 'line': code.co_firstlineno})
+
+        return index
+
+    def _run(self):
+        last = self._start
+
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+
+            if frame is None:
+                break
+
+            stack = []
+            while frame is not None:
+                stack.append(self._frame(frame.f_code))
+                frame = frame.f_back
+
+            # Speedscope stacks run from the root to the leaf
+            self.samples.append(stack[::-1])
+            self.weights.append(now - last)
+            last = now
+
+    def dump(self, name):
+        return json.dumps({
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'shared': {'frames': self.frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': self._end - self._start,
+                'samples': self.samples,
+                'weights': self.weights
+            }],
+            'activeProfileIndex': 0,
+            'exporter': 'login-microservice'
+        }, separators=(',', ':')).encode('utf-8')
+
+def start(mode=None):
+    """Start profiling the calling thread. Returns the profiler, whose id the
+    profile will be saved under, or None if another request of this process
+    is being profiled."""
+    if not _active.acquire(blocking=False):
+        return None
+
+    try:
+        profiler = CProfiler() if (mode or PROFILE_MODE) == 'cprofile' else SamplingProfiler()
+        # Ids sort by time, so the oldest profiles are pruned first
+        profiler.id = f'{int(time.time() * 1000):013d}-{secrets.token_hex(4)}'
+        profiler.start()
+        return profiler
+    except Exception:
+        _active.release()
+        raise
+
+def finish(profiler, method, path, status, seconds):
+    """Stop a profiler from start() and save its profile under profiler.id."""
+    try:
+        profiler.stop()
+    finally:
+        _active.release()
+
+    id = profiler.id
+    extension, _ = FORMATS[profiler.mode]
+    info = {
+        'id': id,
+        'mode': profiler.mode,
+        'method': method,
+        'path': path,
+        'status': status,
+        'duration_ms': round(seconds * 1000, 3),
+        'time': time.time()
+    }
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, id + extension), 'wb') as f:
+        f.write(profiler.dump(f'{method} {path}'))
+    # Written last: a profile is listed once its data is complete
+    with open(os.path.join(PROFILE_DIR, id + '.json'), 'w') as f:
+        json.dump(info, f)
+
+    _prune()
+
+# ----------------------------------------------------- Stored profiles
+def _ids():
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+
+    # <id>.json holds the profile's details; <id>.speedscope.json does not match _ID
+    return sorted(name[:-len('.json')] for name in names if name.endswith('.json') and _ID.match(name[:-len('.json')]))
+
+def _prune():
+    for id in _ids()[:-PROFILE_KEEP or None]:
+        for extension in ['.json'] + [extension for extension, _ in FORMATS.values()]:
+            try:
+                os.unlink(os.path.join(PROFILE_DIR, id + extension))
+            except FileNotFoundError:
+                pass
+
+def list_profiles():
+    """The stored profiles, newest first."""
+    profiles = []
+
+    for id in reversed(_ids()):
+        try:
+            with open(os.path.join(PROFILE_DIR, id + '.json')) as f:
+                profiles.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+
+    return profiles
+
+def load_profile(id):
+    """(data, mimetype, file name) of a stored profile, or None."""
+    if not _ID.match(id):
+        return None
+
+    try:
+        with open(os.path.join(PROFILE_DIR, id + '.json')) as f:
+            info = json.load(f)
+
+        extension, mimetype = FORMATS[info['mode']]
+        with open(os.path.join(PROFILE_DIR, id + extension), 'rb') as f:
+            return f.read(), mimetype, id + extension
+
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
@@ -0,0 +1,231 @@
+"""Sliding-window limits on login attempts.
+
+Checked before a login reads the database or runs bcrypt, so a burst of
+guesses costs a dict lookup per attempt instead of a password check:
+
+- per client IP, every attempt counts: LOGIN_IP_LIMIT per LOGIN_IP_WINDOW seconds
+- per account, failed attempts count: LOGIN_ACCOUNT_LIMIT per
+  LOGIN_ACCOUNT_WINDOW seconds. The account is locked out until old failures
+  leave the window; a successful login clears them.
+
+Each limit is a sliding-window counter: the attempts in the current fixed
+window plus those of the previous one, weighted by how much of it the sliding
+window still covers. That is two integers per key, however many attempts.
+
+With RATE_LIMIT_STORE=memory the counts are per process. RATE_LIMIT_STORE=sqlite
+shares them between the worker processes of a machine through the RATE_LIMIT_DB
+file. If that file cannot be used, attempts are let through rather than
+blocking every login.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+import db
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+LOGIN_IP_LIMIT = int(os.getenv('LOGIN_IP_LIMIT', 30))
+LOGIN_IP_WINDOW = int(os.getenv('LOGIN_IP_WINDOW', 60))
+LOGIN_ACCOUNT_LIMIT = int(os.getenv('LOGIN_ACCOUNT_LIMIT', 10))
+LOGIN_ACCOUNT_WINDOW = int(os.getenv('LOGIN_ACCOUNT_WINDOW', 900))
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memory')
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', 'ratelimit.db')
+# Keys remembered per limit in memory; the least recently used are forgotten
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+
+REJECTIONS = metrics.Counter('rate_limited_total', 'Login attempts refused by a rate limit', ['limit'])
+
+class RateLimited(Exception):
+    """Raised when an attempt is over a limit; retry_after is in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# ----------------------------------------------------- Stores
+class MemoryStore:
+    """Counts of the current and previous window per key, in this process."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _counts(self, key, window):
+        entry = self._data.get(key)
+
+        if entry is None:
+            return 0, 0
+
+        entry_window, previous, current = entry
+        if entry_window == window:
+            return previous, current
+        if entry_window == window - 1:
+            return current, 0
+        return 0, 0
+
+    def counts(self, key, window):
+        with self._lock:
+            return self._counts(key, window)
+
+    def add(self, key, window):
+        with self._lock:
+            previous, current = self._counts(key, window)
+            self._data[key] = (window, previous, current + 1)
+            self._data.move_to_end(key)
+
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+            return previous, current + 1
+
+    def clear(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+class SQLiteStore:
+    """Counts per (limit, key, window) in a SQLite file shared by the worker processes."""
+
+    # Seconds between deletions of windows that can no longer count
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self._next_prune = 0.0
+
+        with db.get_connection(self.path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    window INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (name, key, window)
+                ) WITHOUT ROWID
+            ''')
+
+    def _counts(self, conn, key, window):
+        rows = conn.execute(
+            'SELECT window, count FROM rate_limits WHERE name = ? AND key = ? AND window >= ?',
+            (self.name, key, window - 1)
+        ).fetchall()
+        counts = {row['window']: row['count'] for row in rows}
+        return counts.get(window - 1, 0), counts.get(window, 0)
+
+    def counts(self, key, window):
+        return self._counts(db.get_connection(self.path), key, window)
+
+    def add(self, key, window):
+        with db.get_connection(self.path) as conn:
+            conn.execute(
+                '''INSERT INTO rate_limits (name, key, window, count) VALUES (?, ?, ?, 1)
+                   ON CONFLICT (name, key, window) DO UPDATE SET count = count + 1''',
+                (self.name, key, window)
+            )
+
+            if time.monotonic() >= self._next_prune:
+                self._next_prune = time.monotonic() + self.PRUNE_INTERVAL
+                conn.execute('DELETE FROM rate_limits WHERE name = ? AND window < ?', (self.name, window - 1))
+
+            return self._counts(conn, key, window)
+
+    def clear(self, key):
+        with db.get_connection(self.path) as conn:
+            conn.execute('DELETE FROM rate_limits WHERE name = ? AND key = ?', (self.name, key))
+
+def create_store(name):
+    if RATE_LIMIT_STORE == 'sqlite':
+        return SQLiteStore(RATE_LIMIT_DB, name)
+    if RATE_LIMIT_STORE == 'memory':
+        return MemoryStore(RATE_LIMIT_MAX_KEYS)
+
+    raise ValueError(f"Unknown RATE_LIMIT_STORE {RATE_LIMIT_STORE!r}, expected 'memory' or 'sqlite'")
+
+# ----------------------------------------------------- Limits
+class SlidingWindowLimit:
+    """At most `limit` events per `window` seconds per key; a limit of 0 disables it."""
+
+    def __init__(self, name, limit, window, store):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.store = store
+
+    def _retry_after(self, previous, current, elapsed):
+        """Seconds until the estimate drops below the limit again."""
+        if current >= self.limit:
+            # Only once the current window is the previous one
+            wait = self.window - elapsed + self.window * (1 - self.limit / current)
+        else:
+            wait = self.window * (1 - (self.limit - current) / previous) - elapsed
+
+        return max(1, math.ceil(wait))
+
+    def _enforce(self, previous, current, now, message):
+        elapsed = now % self.window
+        estimate = previous * (1 - elapsed / self.window) + current
+
+        if estimate >= self.limit:
+            REJECTIONS.inc(self.name)
+            raise RateLimited(message, self._retry_after(previous, current, elapsed))
+
+    def _call(self, fn, *args):
+        # A store that cannot be read or written lets the attempt through
+        try:
+            return fn(*args)
+        except sqlite3.Error:
+            return None
+
+    def check(self, key, message):
+        """Raise RateLimited if the key is at its limit, without counting an event."""
+        if self.limit <= 0:
+            return
+
+        now = time.time()
+        counts = self._call(self.store.counts, key, int(now // self.window))
+        if counts:
+            self._enforce(*counts, now, message)
+
+    def hit(self, key, message):
+        """Count an event, then raise RateLimited if the key went over its limit."""
+        if self.limit <= 0:
+            return
+
+        now = time.time()
+        counts = self._call(self.store.add, key, int(now // self.window))
+        if counts:
+            # The event just counted is allowed up to and including the limit
+            previous, current = counts
+            self._enforce(previous, current - 1, now, message)
+
+    def record(self, key):
+        """Count an event without checking the limit."""
+        if self.limit > 0:
+            self._call(self.store.add, key, int(time.time() // self.window))
+
+    def clear(self, key):
+        if self.limit > 0:
+            self._call(self.store.clear, key)
+
+LOGIN_BY_IP = SlidingWindowLimit('ip', LOGIN_IP_LIMIT, LOGIN_IP_WINDOW, create_store('login_ip'))
+LOGIN_BY_ACCOUNT = SlidingWindowLimit('account', LOGIN_ACCOUNT_LIMIT, LOGIN_ACCOUNT_WINDOW, create_store('login_account'))
+
+def _account(email):
+    return str(email).strip().lower()
+
+def check_login(ip, email):
+    """Count a login attempt from ip and raise RateLimited if ip or the account is over its limit."""
+    LOGIN_BY_IP.hit(ip or 'unknown', "Too many login attempts from this address, please try again later")
+    LOGIN_BY_ACCOUNT.check(_account(email), "Too many failed login attempts for this account, please try again later")
+
+def login_failed(email):
+    LOGIN_BY_ACCOUNT.record(_account(email))
+
+def login_succeeded(email):
+    LOGIN_BY_ACCOUNT.clear(_account(email))
@@ -0,0 +1,60 @@
+import os
+import hashlib
+import secrets
+import time
+from dotenv import load_dotenv
+import storage
+
+# Load environment variables from .env file
+load_dotenv()
+REFRESH_TOKEN_TTL = int(os.getenv('REFRESH_TOKEN_TTL', 7 * 24 * 3600))
+
+# Refresh tokens are random strings; only their SHA-256 digest is stored.
+# Every refresh marks the presented token used and hands out a new one of the
+# same family. Presenting a used token again means it was copied, so the whole
+# family (that login's session) is deleted. A password change deletes all of
+# the user's families (see UnitOfWork.update_user).
+
+def _digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+def issue(user_id):
+    """Start a new session for a user with a fresh refresh token."""
+    backend = storage.get_backend()
+    token = secrets.token_urlsafe(32)
+    now = int(time.time())
+
+    try:
+        backend.insert_refresh_token(_digest(token), secrets.token_bytes(16), user_id, now + REFRESH_TOKEN_TTL, now)
+        return [201, token]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def rotate(token):
+    """Exchange a refresh token for a new one. Returns [200, (new token, user id)]."""
+    backend = storage.get_backend()
+    new_token = secrets.token_urlsafe(32)
+    now = int(time.time())
+
+    try:
+        user_id = backend.rotate_refresh_token(_digest(token), _digest(new_token), now + REFRESH_TOKEN_TTL, now)
+
+        if user_id is None:
+            return [401, {"error": "Invalid or expired refresh token. Please log in again."}]
+
+        return [200, (new_token, user_id)]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def revoke(token):
+    """End the session a refresh token belongs to."""
+    backend = storage.get_backend()
+
+    try:
+        backend.delete_refresh_token_family(_digest(token))
+        return [200, {"message": "Refresh token revoked"}]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
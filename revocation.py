@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from dotenv import load_dotenv
+import metrics
+import storage
+
+# Load environment variables from .env file
+load_dotenv()
+REVOCATION_SYNC_INTERVAL = float(os.getenv('REVOCATION_SYNC_INTERVAL', 5))
+# Seconds between deleting expired revocations from the database. The list is
+# then fetched again in full, in case an incremental sync missed a row
+# committed out of id order.
+REVOCATION_PRUNE_INTERVAL = 3600
+
+# Ids (jti claims) of revoked tokens with their expiry, checked on every
+# protected request - a dict lookup, with no database query. Revocations made
+# by this process are added straight away; those made by other processes and
+# replicas are fetched every REVOCATION_SYNC_INTERVAL seconds by the first
+# request that finds the list stale.
+_revoked = {}
+_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_last_id = 0
+_next_sync = 0.0
+_next_prune = 0.0
+
+def revoke(jti, expires_at):
+    backend = storage.get_backend()
+
+    try:
+        backend.revoke_token(jti, int(expires_at))
+
+        with _lock:
+            _revoked[jti] = int(expires_at)
+
+        return [201, {"message": "Token revoked"}]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def is_revoked(jti):
+    if jti is None:
+        return False
+
+    if time.monotonic() >= _next_sync:
+        sync(wait=False)
+
+    return jti in _revoked
+
+def sync(wait=True):
+    """Fetch the revocations made since the last sync and forget expired ones.
+
+    One thread syncs at a time; with wait=False other threads carry on with
+    the current list instead of waiting. If the database cannot be read, the
+    current list is kept until the next attempt.
+    """
+    global _last_id, _next_sync, _next_prune
+
+    if not _sync_lock.acquire(blocking=wait):
+        return
+
+    try:
+        backend = storage.get_backend()
+        now = time.time()
+        full = time.monotonic() >= _next_prune
+
+        try:
+            if full:
+                backend.prune_revoked_tokens(int(now))
+            rows = backend.revoked_tokens(0 if full else _last_id, int(now))
+        except backend.Error:
+            rows = []
+        else:
+            if full:
+                _next_prune = time.monotonic() + REVOCATION_PRUNE_INTERVAL
+
+        with _lock:
+            for id, jti, expires_at in rows:
+                _revoked[jti] = expires_at
+                _last_id = max(_last_id, id)
+
+            for jti in [jti for jti, expires_at in _revoked.items() if expires_at <= now]:
+                del _revoked[jti]
+
+        _next_sync = time.monotonic() + REVOCATION_SYNC_INTERVAL
+
+    finally:
+        _sync_lock.release()
+
+def stats():
+    return {
+        "size": len(_revoked),
+        "last_id": _last_id
+    }
+
+metrics.add_collector(lambda: metrics.gauge_lines(
+    'revoked_tokens', 'Unexpired revoked tokens known to this process',
+    {(): len(_revoked)}
+))
@@ -0,0 +1,175 @@
+"""Keys that sign and verify the access tokens.
+
+JWT_ALGORITHM=HS256 (the default) signs with the shared SECRET_KEY, which
+every service verifying tokens must then hold. With RS256 or EdDSA (Ed25519)
+tokens are signed with a private key from JWT_KEYS_DIR, and the public keys
+are published at GET /.well-known/jwks.json so other services verify tokens
+themselves. Each token names its key in the 'kid' header.
+
+Create the first key with `python signing.py new-key`: replicas must share
+JWT_KEYS_DIR, so a missing key stops the service from starting instead of
+each process making its own. JWT_GENERATE_KEY=on makes one for development.
+
+Rotating keys: add a new key file (`python signing.py new-key`) and restart.
+Every key in the directory verifies tokens and is published; the newest one,
+or JWT_SIGNING_KID, signs. Remove a key once tokens signed with it expired.
+"""
+import os
+import sys
+import json
+import base64
+import hashlib
+import tempfile
+import time
+import jwt
+from dotenv import load_dotenv
+from precomputed import PrecomputedResponse
+import startup
+
+# Load environment variables from .env file
+load_dotenv()
+SECRET_KEY = os.getenv('SECRET_KEY')
+JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', 'HS256')
+JWT_KEYS_DIR = os.getenv('JWT_KEYS_DIR', 'keys')
+JWT_SIGNING_KID = os.getenv('JWT_SIGNING_KID')
+# 'on' creates a key in an empty JWT_KEYS_DIR, for development only
+JWT_GENERATE_KEY = os.getenv('JWT_GENERATE_KEY', 'off')
+# Seconds other services may cache the key set for. A new key must be
+# published for this long before it signs, see JWT_SIGNING_KID.
+JWKS_MAX_AGE = int(os.getenv('JWKS_MAX_AGE', 300))
+
+ALGORITHMS = ('HS256', 'RS256', 'EdDSA')
+# Size of generated RSA keys
+RSA_KEY_SIZE = 2048
+
+# ----------------------------------------------------- Key files
+def generate_key(algorithm=JWT_ALGORITHM):
+    """A new private key for the algorithm, as PEM."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if algorithm == 'RS256':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=RSA_KEY_SIZE)
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+
+def write_key(directory, name, pem):
+    """Write a key file, unless one of that name exists. Returns whether it was written.
+
+    The key is written to a temporary file first and linked into place, so
+    processes starting together never read a half-written key.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+        os.link(tmp, os.path.join(directory, name))
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.unlink(tmp)
+
+def load_keys(directory, algorithm=JWT_ALGORITHM, generate=False):
+    """The private keys in the directory's *.pem files, oldest first by file name.
+
+    With generate, an empty directory gets a first key, initial.pem, so a
+    development setup needs no steps; otherwise it raises RuntimeError. Keys
+    added by `new-key` are named key-<UTC time>.pem and sort after it.
+    """
+    from cryptography.hazmat.primitives import serialization
+
+    if not os.path.isdir(directory) or not any(name.endswith('.pem') for name in os.listdir(directory)):
+        if not generate:
+            raise RuntimeError(
+                f"No signing key in {directory}: create one with `python signing.py new-key` "
+                f"and share the directory between replicas, or set JWT_GENERATE_KEY=on for development"
+            )
+        write_key(directory, 'initial.pem', generate_key(algorithm))
+
+    keys = []
+    for name in sorted(name for name in os.listdir(directory) if name.endswith('.pem')):
+        with open(os.path.join(directory, name), 'rb') as f:
+            keys.append(serialization.load_pem_private_key(f.read(), password=None))
+
+    return keys
+
+# ----------------------------------------------------- JWKs
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def public_jwk(key, algorithm=JWT_ALGORITHM):
+    """The public half of a private key as a JWK, with its RFC 7638 thumbprint as 'kid'."""
+    if algorithm == 'RS256':
+        jwk = jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key(), as_dict=True)
+        members = {name: jwk[name] for name in ('e', 'kty', 'n')}
+    else:
+        jwk = jwt.algorithms.OKPAlgorithm.to_jwk(key.public_key(), as_dict=True)
+        members = {name: jwk[name] for name in ('crv', 'kty', 'x')}
+
+    thumbprint = hashlib.sha256(json.dumps(members, separators=(',', ':'), sort_keys=True).encode('utf-8')).digest()
+    return {**members, 'kid': _b64(thumbprint), 'use': 'sig', 'alg': algorithm}
+
+# ----------------------------------------------------- Key set
+if JWT_ALGORITHM not in ALGORITHMS:
+    raise ValueError(f"JWT_ALGORITHM must be one of {', '.join(ALGORITHMS)}, not {JWT_ALGORITHM!r}")
+
+# `python signing.py new-key` loads no keys: it may be making the first one
+if JWT_ALGORITHM == 'HS256' or __name__ == '__main__':
+    _signing_key = SECRET_KEY
+    _signing_kid = None
+    _verification_keys = {}
+    JWKS = {'keys': []}
+
+else:
+    with startup.phase('keys'):
+        _private_keys = load_keys(JWT_KEYS_DIR, generate=JWT_GENERATE_KEY == 'on')
+    _jwks = [public_jwk(key) for key in _private_keys]
+    _verification_keys = {jwk['kid']: key.public_key() for jwk, key in zip(_jwks, _private_keys)}
+
+    _signing_kid = JWT_SIGNING_KID or _jwks[-1]['kid']
+    if _signing_kid not in _verification_keys:
+        raise ValueError(f"JWT_SIGNING_KID {_signing_kid!r} is not one of the keys in {JWT_KEYS_DIR}")
+    _signing_key = _private_keys[[jwk['kid'] for jwk in _jwks].index(_signing_kid)]
+    JWKS = {'keys': _jwks}
+
+# Served at GET /.well-known/jwks.json. With HS256 the set is empty: the
+# secret is never published.
+JWKS_RESPONSE = PrecomputedResponse(json.dumps(JWKS, separators=(',', ':')), cache_control=f'public, max-age={JWKS_MAX_AGE}')
+
+def encode(payload):
+    headers = {'kid': _signing_kid} if _signing_kid else None
+    return jwt.encode(payload, _signing_key, algorithm=JWT_ALGORITHM, headers=headers)
+
+def decode(token):
+    """Verify a token and return its payload. Raises jwt.InvalidTokenError.
+
+    Only JWT_ALGORITHM is accepted, so a token cannot choose how it is checked.
+    """
+    if JWT_ALGORITHM == 'HS256':
+        return jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+
+    key = _verification_keys.get(jwt.get_unverified_header(token).get('kid'))
+    if key is None:
+        raise jwt.InvalidTokenError('Unknown signing key')
+
+    return jwt.decode(token, key, algorithms=[JWT_ALGORITHM])
+
+if __name__ == '__main__':
+    # python signing.py new-key: add a key to JWT_KEYS_DIR and print its kid
+    if sys.argv[1:] != ['new-key'] or JWT_ALGORITHM == 'HS256':
+        sys.exit("Usage: JWT_ALGORITHM=RS256|EdDSA python signing.py new-key")
+
+    from cryptography.hazmat.primitives import serialization
+
+    pem = generate_key()
+    write_key(JWT_KEYS_DIR, time.strftime('key-%Y%m%dT%H%M%SZ.pem', time.gmtime()), pem)
+    print(public_jwk(serialization.load_pem_private_key(pem, password=None))['kid'])
@@ -0,0 +1,37 @@
+"""Timing of the service's startup, reported once it is ready to serve.
+
+Imported first by app.py, so the time until report() covers the imports of
+the service and its dependencies; phase() times the named steps in between.
+"""
+import logging
+import time
+from contextlib import contextmanager
+import metrics
+
+_start = time.perf_counter()
+PHASES = {}
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASES[name] = PHASES.get(name, 0) + time.perf_counter() - start
+
+def report():
+    """Record the startup time and log it, split into imports and phases."""
+    total = time.perf_counter() - _start
+    PHASES['imports'] = max(0.0, total - sum(seconds for name, seconds in PHASES.items() if name != 'imports'))
+    PHASES['total'] = total
+
+    logging.getLogger('startup').info(
+        f"Started in {total:.3f}s (" + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in PHASES.items() if name != 'total') + ")",
+        extra={'fields': {'phases': {name: round(seconds, 6) for name, seconds in PHASES.items()}}}
+    )
+
+metrics.add_collector(lambda: metrics.gauge_lines(
+    'startup_seconds', 'Seconds spent starting this process, by phase',
+    {(name,): seconds for name, seconds in PHASES.items()},
+    ['phase']
+))
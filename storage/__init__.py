@@ -0,0 +1,42 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+
+_backend = None
+
+def create_backend(name=None):
+    """Create the storage backend called name (default STORAGE_BACKEND):
+    'sqlite' for the local DB_PATH file, 'sharded' for DB_SHARDS SQLite files,
+    or 'postgres' for DATABASE_URL."""
+    name = name or STORAGE_BACKEND
+
+    if name == 'sqlite':
+        from storage.sqlite import SQLiteStore
+        return SQLiteStore()
+
+    if name == 'sharded':
+        from storage.sharded import ShardedStore
+        return ShardedStore()
+
+    if name == 'postgres':
+        from storage.postgres import PostgresStore
+        return PostgresStore()
+
+    raise ValueError(f"Unknown STORAGE_BACKEND '{name}', expected 'sqlite', 'sharded' or 'postgres'")
+
+def get_backend():
+    """The backend shared by this process, created and migrated on first use."""
+    global _backend
+
+    if _backend is None:
+        import startup
+
+        backend = create_backend()
+        with startup.phase('migrations'):
+            backend.migrate()
+        _backend = backend
+
+    return _backend
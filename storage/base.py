@@ -0,0 +1,197 @@
+import json
+
+class UnitOfWork:
+    """Writes that run on one connection, in one transaction: either all of
+    them are committed or none. Made by UserStore.unit_of_work().
+
+    The ids of the users written to are collected in `changed`, so the
+    caller can drop their cached records once the transaction commits. Each
+    of them also gets an outbox row (see record_changes) in the transaction.
+    """
+
+    def __init__(self):
+        self.changed = set()
+        self.created = set()
+
+    def insert_user(self, email, password):
+        """Insert a user unless the email is taken. Returns the new id, or None."""
+        raise NotImplementedError
+
+    def update_user(self, id, fields):
+        """Set the given 'email'/'password' fields. Returns False if there is no such user.
+
+        Setting 'password' also deletes the user's refresh tokens."""
+        raise NotImplementedError
+
+    def delete_user(self, id):
+        """Delete a user and their roles. Returns False if there is no such user."""
+        raise NotImplementedError
+
+    def add_role(self, user_id, role):
+        """Give a user a role. Returns False if there is no such user."""
+        raise NotImplementedError
+
+    def remove_role(self, user_id, role):
+        """Take a role from a user. Returns False if there is no such user."""
+        raise NotImplementedError
+
+    def insert_users(self, users):
+        """Insert many {'email', 'password', 'roles'} users.
+
+        Returns ({email: new id}, set of emails that were already taken).
+        """
+        raise NotImplementedError
+
+    def update_roles(self, changes):
+        """Apply many {'id', 'new_role'} / {'id', 'remove_role'} changes,
+        additions first. Returns the set of ids that exist."""
+        raise NotImplementedError
+
+    def record_changes(self):
+        """Append a row per changed user to the outbox. Called by the backend
+        as the last step before the commit."""
+        raise NotImplementedError
+
+    def _outbox_rows(self, users, now):
+        # (user_id, type, state as JSON, time) per changed user, from the
+        # {id: {'id', 'email', 'roles'}} states the transaction leaves behind.
+        # A user that is gone was deleted.
+        for id in sorted(self.changed):
+            state = users.get(id)
+
+            if state is None:
+                yield id, 'deleted', None, now
+            else:
+                yield id, 'created' if id in self.created else 'updated', json.dumps(state, separators=(',', ':')), now
+
+class UserStore:
+    """Interface of a storage backend for users and their roles.
+
+    user.py turns results into [status, result] pairs and caches records;
+    backends only talk to the database. A user record is a dict with 'id',
+    'email', 'password' (the bcrypt hash as bytes) and 'roles' (a list).
+    Backends raise their own errors, all subclasses of Error.
+
+    Every write to users and roles goes through a unit of work, so that it
+    is recorded in the outbox read by changes().
+    """
+
+    Error = Exception
+
+    def migrate(self):
+        """Create or upgrade the schema. Returns the schema version."""
+        raise NotImplementedError
+
+    def ping(self):
+        """Run a trivial query, raising Error if the database is unusable."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # ----------------------------------------------------- Reads
+    def list_users(self, after_id=0, limit=None, role=None, email_prefix=None):
+        """Yield {'id', 'email', 'roles'} dicts ordered by id, streaming from the database."""
+        raise NotImplementedError
+
+    def find_user_by_id(self, id):
+        """Return the user record, or None."""
+        raise NotImplementedError
+
+    def find_user_by_email(self, email):
+        """Return the user record, or None."""
+        raise NotImplementedError
+
+    def existing_emails(self, emails):
+        """Return the subset of emails that belong to a user."""
+        raise NotImplementedError
+
+    # ----------------------------------------------------- Writes
+    def unit_of_work(self):
+        """Context manager yielding a UnitOfWork, committed when the block
+        ends and rolled back if it raises. The only way to change users and
+        roles: callers go through user.unit_of_work(), which drops cached
+        records and wakes GET /changes after the commit."""
+        raise NotImplementedError
+
+    def replace_password(self, id, old, new):
+        """Set a user's password hash to new if it is still old. Returns whether it was set.
+
+        Not a change for the outbox: the hash is never published."""
+        raise NotImplementedError
+
+    # ----------------------------------------------------- Outbox
+    def parse_cursor(self, value):
+        """The outbox cursor a GET /changes `since` value names ('' or None
+        for the start). Raises ValueError."""
+        if value is None or value == '':
+            return 0
+
+        if not value.isdigit():
+            raise ValueError(value)
+
+        return int(value)
+
+    def format_cursor(self, cursor):
+        """A cursor as it is returned in JSON."""
+        return cursor
+
+    def read_changes(self, after, limit):
+        """(rows, None) with up to limit changes after the cursor, see
+        changes(); or (None, the latest cursor) if some of them were pruned."""
+        # A gap in the ids is not enough: in PostgreSQL a transaction that
+        # rolled back leaves one too
+        if after < self.last_pruned_change():
+            return None, self.change_bounds()[1]
+
+        return self.changes(after, limit), None
+
+    def changes(self, after_id=0, limit=None):
+        """Return up to limit outbox rows with an id above after_id, ordered
+        by id, as {'cursor', 'type', 'id', 'user', 'time'} dicts. 'user' is
+        the user's {'id', 'email', 'roles'} after the change, or None once
+        deleted."""
+        raise NotImplementedError
+
+    def change_bounds(self):
+        """Return the lowest and highest outbox ids, or (None, None) if it is empty."""
+        raise NotImplementedError
+
+    def last_pruned_change(self):
+        """Return the highest outbox id deleted by prune_changes(), or 0."""
+        raise NotImplementedError
+
+    def prune_changes(self, before):
+        """Delete the outbox rows written before the Unix time before,
+        always keeping the newest row so the highest id stays known, and
+        record the highest id deleted for last_pruned_change()."""
+        raise NotImplementedError
+
+    # ----------------------------------------------------- Revoked tokens
+    def revoke_token(self, jti, expires_at):
+        """Record a token id as revoked until expires_at (a Unix time)."""
+        raise NotImplementedError
+
+    def revoked_tokens(self, after_id=0, now=0):
+        """Return (id, jti, expires_at) of the revocations with an id above
+        after_id that expire after now, ordered by id."""
+        raise NotImplementedError
+
+    def prune_revoked_tokens(self, now):
+        """Delete the revocations that expired before now."""
+        raise NotImplementedError
+
+    # ----------------------------------------------------- Refresh tokens
+    def insert_refresh_token(self, token_hash, family, user_id, expires_at, now):
+        """Store a refresh token digest, dropping the user's expired ones."""
+        raise NotImplementedError
+
+    def rotate_refresh_token(self, token_hash, new_hash, expires_at, now):
+        """Mark a refresh token used and store new_hash in its family, in one
+        transaction. Returns the user id, or None if the token is unknown,
+        expired or already used - in which case its whole family is deleted."""
+        raise NotImplementedError
+
+    def delete_refresh_token_family(self, token_hash):
+        """Delete a refresh token and every token of its family."""
+        raise NotImplementedError
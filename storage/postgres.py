@@ -0,0 +1,519 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+from dotenv import load_dotenv
+import metrics
+from db import _operation
+from migrations import USERS_TABLE, ROLES_TABLE, REVOKED_TOKENS_TABLE, REFRESH_TOKENS_TABLE, OUTBOX_TABLE, OUTBOX_PRUNED_TABLE
+from storage.base import UnitOfWork, UserStore
+
+# Load environment variables from .env file
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://localhost/login')
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', 1))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', 10))
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', 5))
+# Rows fetched per round trip while streaming GET /users
+PG_STREAM_ROWS = 500
+
+# Key of the advisory lock held while migrating, so that several workers
+# starting at once do not apply the same migration twice
+MIGRATION_LOCK = 0x6c6f67696e
+# Key of the lock taken before writing outbox rows, see PostgresUnitOfWork.record_changes
+OUTBOX_LOCK = 0x6f7574626f78
+
+# Schema migrations, applied in order and recorded in schema_version. Never
+# edit a released migration - append a new one instead.
+MIGRATIONS = [
+    # 1: users and their roles, deleted along with their user, an index for
+    # finding the users that have a role and one for email prefix searches
+    [
+        f'''CREATE TABLE IF NOT EXISTS {USERS_TABLE} (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            email TEXT NOT NULL UNIQUE,
+            password BYTEA NOT NULL
+        )''',
+        f'''CREATE TABLE IF NOT EXISTS {ROLES_TABLE} (
+            user_id BIGINT NOT NULL REFERENCES {USERS_TABLE} (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            PRIMARY KEY (user_id, role)
+        )''',
+        f'CREATE INDEX IF NOT EXISTS {ROLES_TABLE}_role_idx ON {ROLES_TABLE} (role, user_id)',
+        f'CREATE INDEX IF NOT EXISTS {USERS_TABLE}_email_prefix_idx ON {USERS_TABLE} (email text_pattern_ops)'
+    ],
+    # 2: ids (jti claims) of tokens revoked before they expire
+    [
+        f'''CREATE TABLE {REVOKED_TOKENS_TABLE} (
+            id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            jti TEXT NOT NULL UNIQUE,
+            expires_at BIGINT NOT NULL
+        )''',
+        f'CREATE INDEX {REVOKED_TOKENS_TABLE}_expires_idx ON {REVOKED_TOKENS_TABLE} (expires_at)'
+    ],
+    # 3: refresh tokens, by SHA-256 digest, rotated within a family
+    [
+        f'''CREATE TABLE {REFRESH_TOKENS_TABLE} (
+            token_hash BYTEA PRIMARY KEY,
+            family BYTEA NOT NULL,
+            user_id BIGINT NOT NULL REFERENCES {USERS_TABLE} (id) ON DELETE CASCADE,
+            expires_at BIGINT NOT NULL,
+            used BOOLEAN NOT NULL DEFAULT FALSE
+        )''',
+        f'CREATE INDEX {REFRESH_TOKENS_TABLE}_family_idx ON {REFRESH_TOKENS_TABLE} (family)',
+        f'CREATE INDEX {REFRESH_TOKENS_TABLE}_user_idx ON {REFRESH_TOKENS_TABLE} (user_id, expires_at)'
+    ],
+    # 4: the outbox - a row per user changed, written in the transaction
+    # that changed it, with the user's state afterwards as JSON
+    [
+        f'''CREATE TABLE {OUTBOX_TABLE} (
+            id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT,
+            created_at BIGINT NOT NULL
+        )''',
+        f'CREATE INDEX {OUTBOX_TABLE}_created_idx ON {OUTBOX_TABLE} (created_at)'
+    ],
+    # 5: the highest outbox id deleted by pruning. Ids of rolled back
+    # transactions leave gaps too, so a gap alone does not mean rows are gone.
+    [
+        f'''CREATE TABLE {OUTBOX_PRUNED_TABLE} (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            last_id BIGINT NOT NULL
+        )''',
+        f'INSERT INTO {OUTBOX_PRUNED_TABLE} (id, last_id) SELECT 0, COALESCE(MIN(id) - 1, 0) FROM {OUTBOX_TABLE}'
+    ]
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+class TimedCursor(psycopg.Cursor):
+    """Cursor recording each query's time, including the round trip, as the 'db' stage."""
+
+    def execute(self, query, params=None, **kwargs):
+        with metrics.timed('db', _operation(query)):
+            return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        with metrics.timed('db', _operation(query)):
+            return super().executemany(query, params_seq, **kwargs)
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Aggregated roles of u, as an array that psycopg returns as a list
+_ROLES = "COALESCE(array_agg(r.role) FILTER (WHERE r.role IS NOT NULL), '{}') AS roles"
+
+class PostgresUnitOfWork(UnitOfWork):
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+
+    def _user_exists(self, user_id):
+        return self.conn.execute(f'SELECT 1 FROM {USERS_TABLE} WHERE id = %s', (user_id,)).fetchone() is not None
+
+    def insert_user(self, email, password):
+        row = self.conn.execute(
+            f'''
+            INSERT INTO {USERS_TABLE} (email, password)
+            VALUES (%s, %s)
+            ON CONFLICT (email) DO NOTHING
+            RETURNING id
+            ''',
+            (email, password)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        self.changed.add(row['id'])
+        self.created.add(row['id'])
+        return row['id']
+
+    def add_role(self, user_id, role):
+        # Inserts nothing if there is no such user, instead of failing the
+        # foreign key
+        cur = self.conn.execute(
+            f'INSERT INTO {ROLES_TABLE} (user_id, role) SELECT id, %s FROM {USERS_TABLE} WHERE id = %s ON CONFLICT DO NOTHING',
+            (role, user_id)
+        )
+
+        if cur.rowcount:
+            self.changed.add(user_id)
+            return True
+
+        # The user already had the role, or does not exist
+        return self._user_exists(user_id)
+
+    def remove_role(self, user_id, role):
+        cur = self.conn.execute(f'DELETE FROM {ROLES_TABLE} WHERE user_id = %s AND role = %s', (user_id, role))
+
+        if cur.rowcount:
+            self.changed.add(user_id)
+            return True
+
+        return self._user_exists(user_id)
+
+    def update_user(self, id, fields):
+        columns = [key for key in ('email', 'password') if key in fields]
+
+        cur = self.conn.execute(
+            f'''
+            UPDATE {USERS_TABLE}
+            SET {', '.join(f'{column} = %s' for column in columns)}
+            WHERE id = %s
+            ''',
+            [fields[column] for column in columns] + [id]
+        )
+
+        if not cur.rowcount:
+            return False
+
+        if 'password' in fields:
+            # A new password ends every session, so a stolen refresh token
+            # cannot outlive the reset
+            self.conn.execute(f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE user_id = %s', (id,))
+
+        self.changed.add(id)
+        return True
+
+    def delete_user(self, id):
+        # The user's roles are removed by ON DELETE CASCADE
+        cur = self.conn.execute(f'DELETE FROM {USERS_TABLE} WHERE id = %s', (id,))
+
+        if not cur.rowcount:
+            return False
+
+        self.changed.add(id)
+        return True
+
+    def insert_users(self, users):
+        cur = self.conn.cursor()
+
+        # ON CONFLICT skips the emails that are taken, so no lock or
+        # existence check is needed; only the inserted rows come back
+        cur.executemany(
+            f'''
+            INSERT INTO {USERS_TABLE} (email, password) VALUES (%s, %s)
+            ON CONFLICT (email) DO NOTHING
+            RETURNING id, email
+            ''',
+            [(u['email'], u['password']) for u in users],
+            returning=True
+        )
+
+        ids = {}
+        while True:
+            row = cur.fetchone()
+            if row:
+                ids[row['email']] = row['id']
+            if not cur.nextset():
+                break
+
+        existing = {u['email'] for u in users if u['email'] not in ids}
+
+        cur.executemany(
+            f'INSERT INTO {ROLES_TABLE} (user_id, role) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+            [(ids[u['email']], role) for u in users if u['email'] in ids for role in (u.get('roles') or ["user"])]
+        )
+
+        self.changed.update(ids.values())
+        self.created.update(ids.values())
+        return ids, existing
+
+    def update_roles(self, changes):
+        cur = self.conn.cursor()
+
+        # FOR SHARE keeps the found users from being deleted before the
+        # role changes are committed
+        cur.execute(
+            f'SELECT id FROM {USERS_TABLE} WHERE id = ANY(%s) FOR SHARE',
+            (list({c['id'] for c in changes}),)
+        )
+        found = {row['id'] for row in cur.fetchall()}
+
+        cur.executemany(
+            f'INSERT INTO {ROLES_TABLE} (user_id, role) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+            [(c['id'], c['new_role']) for c in changes if c['id'] in found and c.get('new_role')]
+        )
+        cur.executemany(
+            f'DELETE FROM {ROLES_TABLE} WHERE user_id = %s AND role = %s',
+            [(c['id'], c['remove_role']) for c in changes if c['id'] in found and c.get('remove_role')]
+        )
+
+        self.changed.update(found)
+        return found
+
+    def record_changes(self):
+        if not self.changed:
+            return
+
+        rows = self.conn.execute(
+            f'''
+            SELECT u.id, u.email, {_ROLES}
+            FROM {USERS_TABLE} u
+            LEFT JOIN {ROLES_TABLE} r ON r.user_id = u.id
+            WHERE u.id = ANY(%s)
+            GROUP BY u.id
+            ''',
+            (list(self.changed),)
+        ).fetchall()
+        users = {row['id']: {'id': row['id'], 'email': row['email'], 'roles': sorted(row['roles'])} for row in rows}
+
+        # Identity values are handed out before commit, so two transactions
+        # could commit their outbox rows out of id order, and a reader that
+        # already passed the later id would never see the earlier one. The
+        # lock, held until commit, makes outbox writers take turns for the
+        # last statement of their transaction only.
+        self.conn.execute('SELECT pg_advisory_xact_lock(%s)', (OUTBOX_LOCK,))
+        self.conn.cursor().executemany(
+            f'INSERT INTO {OUTBOX_TABLE} (user_id, type, data, created_at) VALUES (%s, %s, %s, %s)',
+            list(self._outbox_rows(users, int(time.time())))
+        )
+
+class PostgresStore(UserStore):
+    """Users and roles in the PostgreSQL database at url (default
+    DATABASE_URL), through a pool of PG_POOL_MIN to PG_POOL_MAX connections
+    shared by all threads. Waiting longer than PG_POOL_TIMEOUT for a free
+    connection raises psycopg_pool.PoolTimeout."""
+
+    Error = psycopg.Error
+
+    def __init__(self, url=None):
+        self._pool = ConnectionPool(
+            url or DATABASE_URL,
+            min_size=PG_POOL_MIN,
+            max_size=PG_POOL_MAX,
+            timeout=PG_POOL_TIMEOUT,
+            kwargs={'row_factory': dict_row, 'cursor_factory': TimedCursor},
+            name='login',
+            open=True
+        )
+
+    def _connection(self):
+        # Use as a context manager: commits on success, rolls back on error
+        # and returns the connection to the pool
+        return self._pool.connection()
+
+    def close(self):
+        self._pool.close()
+
+    def migrate(self):
+        # Fast path for the usual start against an up-to-date schema: no
+        # lock and no DDL
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT to_regclass('schema_version') IS NOT NULL AS present"
+            ).fetchone()
+            if row['present'] and conn.execute('SELECT max(version) AS version FROM schema_version').fetchone()['version'] == SCHEMA_VERSION:
+                return SCHEMA_VERSION
+
+        with self._connection() as conn:
+            conn.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK,))
+            conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+
+            row = conn.execute('SELECT version FROM schema_version').fetchone()
+            version = row['version'] if row else 0
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"Database schema version {version} is newer than this service ({SCHEMA_VERSION})")
+
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+
+            if row is None:
+                conn.execute('INSERT INTO schema_version (version) VALUES (%s)', (SCHEMA_VERSION,))
+            elif version < SCHEMA_VERSION:
+                conn.execute('UPDATE schema_version SET version = %s', (SCHEMA_VERSION,))
+
+        return SCHEMA_VERSION
+
+    def ping(self):
+        with self._connection() as conn:
+            conn.execute('SELECT 1').fetchone()
+
+    # ----------------------------------------------------- Reads
+    def list_users(self, after_id=0, limit=None, role=None, email_prefix=None):
+        query = f'''
+            SELECT u.id, u.email, {_ROLES}
+            FROM {USERS_TABLE} u
+            LEFT JOIN {ROLES_TABLE} r ON r.user_id = u.id
+            WHERE u.id > %s'''
+        values = [after_id or 0]
+
+        if email_prefix:
+            query += ' AND u.email LIKE %s'
+            values.append(_escape_like(email_prefix) + '%')
+
+        if role:
+            query += f' AND EXISTS (SELECT 1 FROM {ROLES_TABLE} f WHERE f.user_id = u.id AND f.role = %s)'
+            values.append(role)
+
+        query += ' GROUP BY u.id ORDER BY u.id'
+
+        if limit:
+            query += ' LIMIT %s'
+            values.append(limit)
+
+        # A server-side cursor fetches PG_STREAM_ROWS rows at a time; the
+        # pooled connection is held until the generator is exhausted or closed
+        with self._connection() as conn:
+            with conn.cursor('list_users') as cur:
+                cur.itersize = PG_STREAM_ROWS
+                with metrics.timed('db', 'SELECT'):
+                    cur.execute(query, values)
+
+                for row in cur:
+                    yield {
+                        'id': row['id'],
+                        'email': row['email'],
+                        'roles': row['roles']
+                    }
+
+    def _find_user(self, column, value):
+        with self._connection() as conn:
+            return conn.execute(
+                f'''
+                SELECT u.id, u.email, u.password, {_ROLES}
+                FROM {USERS_TABLE} u
+                LEFT JOIN {ROLES_TABLE} r ON r.user_id = u.id
+                WHERE u.{column} = %s
+                GROUP BY u.id
+                ''',
+                (value,)
+            ).fetchone()
+
+    def find_user_by_id(self, id):
+        return self._find_user('id', id)
+
+    def find_user_by_email(self, email):
+        return self._find_user('email', email)
+
+    def existing_emails(self, emails):
+        with self._connection() as conn:
+            rows = conn.execute(
+                f'SELECT email FROM {USERS_TABLE} WHERE email = ANY(%s)',
+                (list(emails),)
+            ).fetchall()
+            return {row['email'] for row in rows}
+
+    # ----------------------------------------------------- Writes
+    @contextmanager
+    def unit_of_work(self):
+        # The pooled connection's block is one transaction
+        with self._connection() as conn:
+            work = PostgresUnitOfWork(conn)
+            yield work
+            work.record_changes()
+
+    def replace_password(self, id, old, new):
+        with self._connection() as conn:
+            cur = conn.execute(
+                f'UPDATE {USERS_TABLE} SET password = %s WHERE id = %s AND password = %s',
+                (new, id, old)
+            )
+            return cur.rowcount > 0
+
+    # ----------------------------------------------------- Outbox
+    def changes(self, after_id=0, limit=None):
+        query = f'SELECT id, user_id, type, data, created_at FROM {OUTBOX_TABLE} WHERE id > %s ORDER BY id'
+        values = [after_id or 0]
+
+        if limit:
+            query += ' LIMIT %s'
+            values.append(limit)
+
+        with self._connection() as conn:
+            return [
+                {
+                    'cursor': row['id'],
+                    'type': row['type'],
+                    'id': row['user_id'],
+                    'user': json.loads(row['data']) if row['data'] is not None else None,
+                    'time': row['created_at']
+                }
+                for row in conn.execute(query, values).fetchall()
+            ]
+
+    def change_bounds(self):
+        with self._connection() as conn:
+            row = conn.execute(f'SELECT MIN(id) AS first, MAX(id) AS last FROM {OUTBOX_TABLE}').fetchone()
+            return row['first'], row['last']
+
+    def last_pruned_change(self):
+        with self._connection() as conn:
+            return conn.execute(f'SELECT last_id FROM {OUTBOX_PRUNED_TABLE}').fetchone()['last_id']
+
+    def prune_changes(self, before):
+        with self._connection() as conn:
+            conn.execute(
+                f'''WITH deleted AS (
+                    DELETE FROM {OUTBOX_TABLE} WHERE created_at < %s AND id < (SELECT MAX(id) FROM {OUTBOX_TABLE})
+                    RETURNING id
+                )
+                UPDATE {OUTBOX_PRUNED_TABLE} SET last_id = GREATEST(last_id, COALESCE((SELECT MAX(id) FROM deleted), 0))''',
+                (before,)
+            )
+
+    # ----------------------------------------------------- Revoked tokens
+    def revoke_token(self, jti, expires_at):
+        with self._connection() as conn:
+            conn.execute(
+                f'INSERT INTO {REVOKED_TOKENS_TABLE} (jti, expires_at) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+                (jti, expires_at)
+            )
+
+    def revoked_tokens(self, after_id=0, now=0):
+        with self._connection() as conn:
+            rows = conn.execute(
+                f'SELECT id, jti, expires_at FROM {REVOKED_TOKENS_TABLE} WHERE id > %s AND expires_at > %s ORDER BY id',
+                (after_id, now)
+            ).fetchall()
+            return [(row['id'], row['jti'], row['expires_at']) for row in rows]
+
+    def prune_revoked_tokens(self, now):
+        with self._connection() as conn:
+            conn.execute(f'DELETE FROM {REVOKED_TOKENS_TABLE} WHERE expires_at <= %s', (now,))
+
+    # ----------------------------------------------------- Refresh tokens
+    def insert_refresh_token(self, token_hash, family, user_id, expires_at, now):
+        with self._connection() as conn:
+            conn.execute(f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE user_id = %s AND expires_at <= %s', (user_id, now))
+            conn.execute(
+                f'INSERT INTO {REFRESH_TOKENS_TABLE} (token_hash, family, user_id, expires_at) VALUES (%s, %s, %s, %s)',
+                (token_hash, family, user_id, expires_at)
+            )
+
+    def rotate_refresh_token(self, token_hash, new_hash, expires_at, now):
+        with self._connection() as conn:
+            # FOR UPDATE: two refreshes with the same token must not both succeed
+            row = conn.execute(
+                f'SELECT family, user_id, expires_at, used FROM {REFRESH_TOKENS_TABLE} WHERE token_hash = %s FOR UPDATE',
+                (token_hash,)
+            ).fetchone()
+
+            if row is None or row['expires_at'] <= now:
+                return None
+
+            if row['used']:
+                # A used token presented again was copied: end the session
+                conn.execute(f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE family = %s', (row['family'],))
+                return None
+
+            conn.execute(f'UPDATE {REFRESH_TOKENS_TABLE} SET used = TRUE WHERE token_hash = %s', (token_hash,))
+            conn.execute(
+                f'INSERT INTO {REFRESH_TOKENS_TABLE} (token_hash, family, user_id, expires_at) VALUES (%s, %s, %s, %s)',
+                (new_hash, row['family'], row['user_id'], expires_at)
+            )
+            return row['user_id']
+
+    def delete_refresh_token_family(self, token_hash):
+        with self._connection() as conn:
+            conn.execute(
+                f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE family = (SELECT family FROM {REFRESH_TOKENS_TABLE} WHERE token_hash = %s)',
+                (token_hash,)
+            )
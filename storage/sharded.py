@@ -0,0 +1,581 @@
+"""Users and roles spread over several SQLite files ("shards").
+
+SQLite lets one transaction at a time write to a file. With DB_SHARDS files,
+registrations and role changes of users on different shards commit side by
+side, so write throughput grows with the number of shards.
+
+- A user is created on the shard their email hashes to, and their id says
+  which: ids are <number> * SHARD_ID_STRIDE + <shard that created the user>,
+  and a user lives on shard (id % SHARD_ID_STRIDE) % DB_SHARDS for good. A
+  lookup by id goes straight to it.
+- Each shard keeps an index from the emails that hash to it to user ids, which
+  finds users by email and keeps emails unique. A registration writes the
+  user, their roles, the index and the outbox in one transaction on one file.
+- GET /users asks every shard and merges their pages by id.
+
+Changing a user's email claims the new one in its shard's index before the
+user is updated, and lets the old one go afterwards. An entry left behind by
+a failure in between points at a user whose email is something else; it is
+ignored by lookups and taken over by the next user to claim the email.
+
+Bulk imports and role changes are split by shard and are atomic per shard,
+not as a whole. Each shard has its own outbox: the GET /changes cursor holds
+one position per shard, as a string like '12.40.7.3'. Revoked tokens are kept
+on shard 0, refresh tokens on their user's shard.
+
+The number of shards is fixed when the files are created. To change it, or
+to move an unsharded DB_PATH database onto shards, stop the service and run
+
+    python -m storage.sharded --source users.db --shards 4
+
+which copies users, roles and tokens into new shard files (see --help). The
+outbox is not copied: change feed consumers reload users and read from 0.
+"""
+import argparse
+import hashlib
+import heapq
+import itertools
+import os
+import sqlite3
+import sys
+from contextlib import ExitStack, contextmanager
+from dotenv import load_dotenv
+import db
+from migrations import USERS_TABLE, ROLES_TABLE, REVOKED_TOKENS_TABLE, REFRESH_TOKENS_TABLE
+from storage.base import UnitOfWork, UserStore
+from storage.sqlite import SQLiteStore, SQLiteUnitOfWork, _select_in
+
+# Load environment variables from .env file
+load_dotenv()
+DB_SHARDS = int(os.getenv('DB_SHARDS', 4))
+# Path of each shard file, with {shard} for its number; by default next to
+# DB_PATH, e.g. users.0.db, users.1.db, ...
+DB_SHARD_PATTERN = os.getenv('DB_SHARD_PATTERN') or '{}.{{shard}}{}'.format(*os.path.splitext(db.DB_PATH))
+
+# Ids of users created on a shard are that shard's number modulo this, so
+# ids from different shards never collide. Also the largest number of shards.
+SHARD_ID_STRIDE = 1024
+
+EMAILS_TABLE = "emails"
+SHARD_TABLE = "shard"
+
+SHARD_SCHEMA = [
+    f'''CREATE TABLE IF NOT EXISTS {EMAILS_TABLE} (
+        email TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL
+    ) WITHOUT ROWID''',
+    # One row: which shard of how many this file is, and the largest user id
+    # it has given out, so ids of deleted users are not reused
+    f'''CREATE TABLE IF NOT EXISTS {SHARD_TABLE} (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        shard INTEGER NOT NULL,
+        shards INTEGER NOT NULL,
+        last_id INTEGER NOT NULL
+    )'''
+]
+
+def shard_paths(pattern, count):
+    return [pattern.format(shard=i) for i in range(count)]
+
+def email_shard(email, count):
+    """The shard whose index holds email, and where a user with it is created."""
+    digest = hashlib.blake2b(str(email).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+def home_shard(id, count):
+    """The shard the user with this id lives on."""
+    return (id % SHARD_ID_STRIDE) % count
+
+class ShardUnitOfWork(SQLiteUnitOfWork):
+    """A transaction on one shard. Users are inserted with ids of the shard,
+    and added to its email index."""
+
+    def __init__(self, cur, shard):
+        super().__init__(cur)
+        self.shard = shard
+
+    def _allocate_ids(self, count):
+        self.cur.execute(f'SELECT last_id FROM {SHARD_TABLE}')
+        last = self.cur.fetchone()['last_id']
+        first = (last // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE + self.shard.index
+        ids = [first + i * SHARD_ID_STRIDE for i in range(count)]
+
+        if ids:
+            self.cur.execute(f'UPDATE {SHARD_TABLE} SET last_id = ?', (ids[-1],))
+
+        return ids
+
+    def _taken(self, rows):
+        # Index entries whose user still has the email; others are left over
+        return {row['email'] for row in rows if self.shard.store.email_of(row['user_id']) == row['email']}
+
+    def claim_email(self, email, user_id):
+        """Point email at user_id in this shard's index. Returns False if
+        another user has it."""
+        self.cur.execute(f'SELECT email, user_id FROM {EMAILS_TABLE} WHERE email = ?', (email,))
+        row = self.cur.fetchone()
+
+        if row is not None and row['user_id'] != user_id and self._taken([row]):
+            return False
+
+        self.cur.execute(f'INSERT OR REPLACE INTO {EMAILS_TABLE} (email, user_id) VALUES (?, ?)', (email, user_id))
+        return True
+
+    def release_email(self, email, user_id):
+        self.cur.execute(f'DELETE FROM {EMAILS_TABLE} WHERE email = ? AND user_id = ?', (email, user_id))
+
+    def insert_user(self, email, password):
+        self.cur.execute(f'SELECT email, user_id FROM {EMAILS_TABLE} WHERE email = ?', (email,))
+        if self._taken(self.cur.fetchall()):
+            return None
+
+        id, = self._allocate_ids(1)
+        self.cur.execute(f'INSERT INTO {USERS_TABLE} (id, email, password) VALUES (?, ?, ?)', (id, email, password))
+        self.cur.execute(f'INSERT OR REPLACE INTO {EMAILS_TABLE} (email, user_id) VALUES (?, ?)', (email, id))
+
+        self.changed.add(id)
+        self.created.add(id)
+        return id
+
+    def insert_users(self, users):
+        cur = self.cur
+
+        existing = self._taken(_select_in(cur, f'SELECT email, user_id FROM {EMAILS_TABLE} WHERE email IN (%s)', [u['email'] for u in users]))
+        new_users = [u for u in users if u['email'] not in existing]
+        ids = dict(zip([u['email'] for u in new_users], self._allocate_ids(len(new_users))))
+
+        cur.executemany(
+            f'INSERT INTO {USERS_TABLE} (id, email, password) VALUES (?, ?, ?)',
+            [(ids[u['email']], u['email'], u['password']) for u in new_users]
+        )
+        cur.executemany(
+            f'INSERT OR REPLACE INTO {EMAILS_TABLE} (email, user_id) VALUES (?, ?)',
+            list(ids.items())
+        )
+        cur.executemany(
+            f'INSERT OR IGNORE INTO {ROLES_TABLE} (user_id, role) VALUES (?, ?)',
+            [(ids[u['email']], role) for u in new_users for role in (u.get('roles') or ["user"])]
+        )
+
+        self.changed.update(ids.values())
+        self.created.update(ids.values())
+        return ids, existing
+
+class ShardStore(SQLiteStore):
+    """One shard file of a ShardedStore."""
+
+    def __init__(self, path, index, count, store=None):
+        super().__init__(path)
+        self.index = index
+        self.count = count
+        self.store = store
+
+    def _work(self, cur):
+        return ShardUnitOfWork(cur, self)
+
+    def migrate(self):
+        version = super().migrate()
+
+        with self._connection() as conn:
+            for statement in SHARD_SCHEMA:
+                conn.execute(statement)
+            conn.execute(
+                f'INSERT OR IGNORE INTO {SHARD_TABLE} (id, shard, shards, last_id) VALUES (0, ?, ?, 0)',
+                (self.index, self.count)
+            )
+            row = conn.execute(f'SELECT shard, shards FROM {SHARD_TABLE}').fetchone()
+
+        if (row['shard'], row['shards']) != (self.index, self.count):
+            raise RuntimeError(
+                f"{self.path} is shard {row['shard']} of {row['shards']}, not {self.index} of {self.count}; "
+                f"change DB_SHARDS with python -m storage.sharded"
+            )
+
+        return version
+
+class ShardedUnitOfWork(UnitOfWork):
+    """A unit of work over the shards: each write goes to the shard of its
+    user, in a transaction per shard that is opened on first use. The
+    transactions commit one after the other at the end, and roll back
+    together on an error; a failure while committing can leave earlier
+    shards committed."""
+
+    def __init__(self, store, stack):
+        # `changed` and `created` are gathered from the shards' units
+        self.store = store
+        self._stack = stack
+        self._units = {}
+        # Run once every transaction has committed
+        self.after_commit = []
+
+    @property
+    def changed(self):
+        return set().union(*(unit.changed for unit in self._units.values()))
+
+    @property
+    def created(self):
+        return set().union(*(unit.created for unit in self._units.values()))
+
+    def _unit(self, index):
+        unit = self._units.get(index)
+
+        if unit is None:
+            unit = self._units[index] = self._stack.enter_context(self.store.shards[index].unit_of_work())
+
+        return unit
+
+    def _home(self, id):
+        return self._unit(self.store.home_shard(id))
+
+    def insert_user(self, email, password):
+        return self._unit(self.store.email_shard(email)).insert_user(email, password)
+
+    def add_role(self, user_id, role):
+        return self._home(user_id).add_role(user_id, role)
+
+    def remove_role(self, user_id, role):
+        return self._home(user_id).remove_role(user_id, role)
+
+    def update_user(self, id, fields):
+        email = fields.get('email')
+        old = self.store.email_of(id)
+
+        if old is None:
+            return False
+
+        if email is None or email == old:
+            return self._home(id).update_user(id, fields)
+
+        # Claimed before the user is changed, so no one else can take it in
+        # between; when this shard's transaction is not open yet, in one of
+        # its own that commits at once
+        index = self.store.email_shard(email)
+        if index in self._units:
+            claimed = self._units[index].claim_email(email, id)
+        else:
+            with self.store.shards[index].unit_of_work() as unit:
+                claimed = unit.claim_email(email, id)
+
+        if not claimed:
+            raise sqlite3.IntegrityError(f"UNIQUE constraint failed: {USERS_TABLE}.email")
+
+        if not self._home(id).update_user(id, fields):
+            return False
+
+        self.after_commit.append(lambda: self.store.release_email(old, id))
+        return True
+
+    def delete_user(self, id):
+        old = self.store.email_of(id)
+
+        if not self._home(id).delete_user(id):
+            return False
+
+        self.after_commit.append(lambda: self.store.release_email(old, id))
+        return True
+
+    def insert_users(self, users):
+        ids, existing = {}, set()
+
+        # In shard order, as is every unit that writes to several shards, so
+        # two of them never wait on each other's locks
+        for index, group in self.store.group(users, lambda u: self.store.email_shard(u['email'])):
+            group_ids, group_existing = self._unit(index).insert_users(group)
+            ids.update(group_ids)
+            existing |= group_existing
+
+        return ids, existing
+
+    def update_roles(self, changes):
+        found = set()
+
+        for index, group in self.store.group(changes, lambda c: self.store.home_shard(c['id'])):
+            found |= self._unit(index).update_roles(group)
+
+        return found
+
+    def record_changes(self):
+        # Each shard's unit records its own changes in its own outbox
+        pass
+
+class ShardedStore(UserStore):
+    """Users and roles in DB_SHARDS SQLite files named after DB_SHARD_PATTERN."""
+
+    Error = sqlite3.Error
+
+    def __init__(self, pattern=None, count=None):
+        count = count or DB_SHARDS
+
+        if not 1 <= count <= SHARD_ID_STRIDE:
+            raise ValueError(f"DB_SHARDS must be between 1 and {SHARD_ID_STRIDE}")
+
+        self.shards = [ShardStore(path, i, count, self) for i, path in enumerate(shard_paths(pattern or DB_SHARD_PATTERN, count))]
+
+    def email_shard(self, email):
+        return email_shard(email, len(self.shards))
+
+    def home_shard(self, id):
+        return home_shard(id, len(self.shards))
+
+    def group(self, items, key):
+        """(shard, items) pairs of the items on each shard, in shard order."""
+        groups = {}
+        for item in items:
+            groups.setdefault(key(item), []).append(item)
+        return sorted(groups.items())
+
+    def migrate(self):
+        return min(shard.migrate() for shard in self.shards)
+
+    def ping(self):
+        for shard in self.shards:
+            shard.ping()
+
+    # ----------------------------------------------------- Reads
+    def list_users(self, after_id=0, limit=None, role=None, email_prefix=None):
+        # Every shard's page is sorted by id; the merge takes the lowest ids
+        pages = [shard.list_users(after_id, limit, role, email_prefix) for shard in self.shards]
+
+        try:
+            yield from itertools.islice(heapq.merge(*pages, key=lambda u: u['id']), limit)
+        finally:
+            for page in pages:
+                page.close()
+
+    def email_of(self, id):
+        """The email of the user with this id, or None. Reads without a
+        transaction of its own, so it can run inside a unit of work."""
+        row = self.shards[self.home_shard(id)]._connection().execute(
+            f'SELECT email FROM {USERS_TABLE} WHERE id = ?', (id,)
+        ).fetchone()
+        return row['email'] if row else None
+
+    def find_user_by_id(self, id):
+        return self.shards[self.home_shard(id)].find_user_by_id(id)
+
+    def find_user_by_email(self, email):
+        row = self.shards[self.email_shard(email)]._connection().execute(
+            f'SELECT user_id FROM {EMAILS_TABLE} WHERE email = ?', (email,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        data = self.find_user_by_id(row['user_id'])
+        return data if data and data['email'] == email else None
+
+    def existing_emails(self, emails):
+        existing = set()
+
+        for index, group in self.group(set(emails), self.email_shard):
+            cur = self.shards[index]._connection().cursor()
+            rows = _select_in(cur, f'SELECT email, user_id FROM {EMAILS_TABLE} WHERE email IN (%s)', group)
+            existing.update(row['email'] for row in rows if self.email_of(row['user_id']) == row['email'])
+
+        return existing
+
+    # ----------------------------------------------------- Writes
+    @contextmanager
+    def unit_of_work(self):
+        with ExitStack() as stack:
+            work = ShardedUnitOfWork(self, stack)
+            yield work
+
+        for action in work.after_commit:
+            action()
+
+    def release_email(self, email, user_id):
+        """Drop email from the index if it still points at user_id."""
+        # A failure here only leaves an entry that lookups ignore
+        try:
+            with self.shards[self.email_shard(email)].unit_of_work() as unit:
+                unit.release_email(email, user_id)
+        except sqlite3.Error:
+            pass
+
+    def replace_password(self, id, old, new):
+        return self.shards[self.home_shard(id)].replace_password(id, old, new)
+
+    # ----------------------------------------------------- Outbox
+    def parse_cursor(self, value):
+        if value is None or value == '' or value == '0':
+            return (0,) * len(self.shards)
+
+        parts = value.split('.')
+        if len(parts) != len(self.shards) or not all(part.isdigit() for part in parts):
+            raise ValueError(value)
+
+        return tuple(int(part) for part in parts)
+
+    def format_cursor(self, cursor):
+        return '.'.join(str(part) for part in cursor)
+
+    def _merge(self, after, pages, limit):
+        # The shards' rows by time, each shard's in its own order, with the
+        # cursor of each row advancing only that shard's position
+        position = list(after)
+        rows = []
+        merged = heapq.merge(*[[(index, row) for row in page] for index, page in enumerate(pages)], key=lambda item: item[1]['time'])
+
+        for index, row in itertools.islice(merged, limit):
+            position[index] = row['cursor']
+            rows.append({**row, 'cursor': self.format_cursor(position)})
+
+        return rows
+
+    def changes(self, after_id=None, limit=None):
+        after = after_id or self.parse_cursor(None)
+        return self._merge(after, [shard.changes(after[i], limit) for i, shard in enumerate(self.shards)], limit)
+
+    def read_changes(self, after, limit):
+        results = [shard.read_changes(after[i], limit) for i, shard in enumerate(self.shards)]
+
+        if any(rows is None for rows, _ in results):
+            # The consumer reloads every user, so carries on from the latest
+            # change of every shard
+            return None, tuple(
+                latest if rows is None else max(after[i], self.shards[i].change_bounds()[1] or 0)
+                for i, (rows, latest) in enumerate(results)
+            )
+
+        return self._merge(after, [rows for rows, _ in results], limit), None
+
+    def prune_changes(self, before):
+        for shard in self.shards:
+            shard.prune_changes(before)
+
+    # ----------------------------------------------------- Revoked tokens
+    def revoke_token(self, jti, expires_at):
+        self.shards[0].revoke_token(jti, expires_at)
+
+    def revoked_tokens(self, after_id=0, now=0):
+        return self.shards[0].revoked_tokens(after_id, now)
+
+    def prune_revoked_tokens(self, now):
+        self.shards[0].prune_revoked_tokens(now)
+
+    # ----------------------------------------------------- Refresh tokens
+    def _refresh_token_shard(self, token_hash):
+        for shard in self.shards:
+            if shard._connection().execute(f'SELECT 1 FROM {REFRESH_TOKENS_TABLE} WHERE token_hash = ?', (token_hash,)).fetchone():
+                return shard
+        return None
+
+    def insert_refresh_token(self, token_hash, family, user_id, expires_at, now):
+        self.shards[self.home_shard(user_id)].insert_refresh_token(token_hash, family, user_id, expires_at, now)
+
+    def rotate_refresh_token(self, token_hash, new_hash, expires_at, now):
+        shard = self._refresh_token_shard(token_hash)
+        return shard.rotate_refresh_token(token_hash, new_hash, expires_at, now) if shard else None
+
+    def delete_refresh_token_family(self, token_hash):
+        shard = self._refresh_token_shard(token_hash)
+        if shard:
+            shard.delete_refresh_token_family(token_hash)
+
+# ----------------------------------------------------- Resharding
+def reshard(sources, targets):
+    """Copy the users, roles and tokens of the SQLite files sources (an
+    unsharded database, or every shard of a sharded one) into the new shard
+    files targets. Returns the number of users copied."""
+    for path in targets:
+        if os.path.exists(path):
+            raise FileExistsError(f"{path} already exists")
+
+    count = len(targets)
+
+    # Brings the sources up to date with this service's schema
+    for path in sources:
+        SQLiteStore(path).migrate()
+
+    conns = []
+    copied = 0
+
+    try:
+        for i, path in enumerate(targets):
+            ShardStore(path, i, count).migrate()
+            db.close_connection(path)
+
+            conn = sqlite3.connect(path, isolation_level=None)
+            conns.append(conn)
+            conn.execute('PRAGMA foreign_keys=ON')
+            conn.execute('BEGIN IMMEDIATE')
+
+        for path in sources:
+            source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+            try:
+                for id, email, password in source.execute(f'SELECT id, email, password FROM {USERS_TABLE}'):
+                    conns[home_shard(id, count)].execute(f'INSERT INTO {USERS_TABLE} (id, email, password) VALUES (?, ?, ?)', (id, email, password))
+                    conns[email_shard(email, count)].execute(f'INSERT INTO {EMAILS_TABLE} (email, user_id) VALUES (?, ?)', (email, id))
+                    copied += 1
+
+                for user_id, role in source.execute(f'SELECT user_id, role FROM {ROLES_TABLE}'):
+                    conns[home_shard(user_id, count)].execute(f'INSERT INTO {ROLES_TABLE} (user_id, role) VALUES (?, ?)', (user_id, role))
+
+                for row in source.execute(f'SELECT token_hash, family, user_id, expires_at, used FROM {REFRESH_TOKENS_TABLE}'):
+                    conns[home_shard(row[2], count)].execute(
+                        f'INSERT INTO {REFRESH_TOKENS_TABLE} (token_hash, family, user_id, expires_at, used) VALUES (?, ?, ?, ?, ?)', row
+                    )
+
+                conns[0].executemany(
+                    f'INSERT OR IGNORE INTO {REVOKED_TOKENS_TABLE} (jti, expires_at) VALUES (?, ?)',
+                    source.execute(f'SELECT jti, expires_at FROM {REVOKED_TOKENS_TABLE}')
+                )
+            finally:
+                source.close()
+
+        for conn in conns:
+            conn.execute(f'UPDATE {SHARD_TABLE} SET last_id = (SELECT COALESCE(MAX(id), 0) FROM {USERS_TABLE})')
+            conn.execute('COMMIT')
+
+    except BaseException:
+        for conn in conns:
+            conn.close()
+        # Nothing was committed: remove the new files, so the copy can be run again
+        for path in targets:
+            db.close_connection(path)
+            for name in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(name):
+                    os.unlink(name)
+        raise
+
+    for conn in conns:
+        conn.close()
+
+    return copied
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy users into a new set of shard files, with the service stopped.")
+    parser.add_argument('--source', default=None, help='database to copy: a file, or a pattern with {shard} for the shards of a sharded one (default DB_PATH)')
+    parser.add_argument('--source-shards', type=int, default=None, help='number of shards of a --source pattern')
+    parser.add_argument('--target', default=DB_SHARD_PATTERN, help=f'pattern of the new shard files (default DB_SHARD_PATTERN, {DB_SHARD_PATTERN})')
+    parser.add_argument('--shards', type=int, default=DB_SHARDS, help=f'number of new shards (default DB_SHARDS, {DB_SHARDS})')
+    args = parser.parse_args(argv)
+
+    source = args.source or db.DB_PATH
+    if '{shard}' in source:
+        if not args.source_shards:
+            parser.error("--source-shards is needed with a --source pattern")
+        sources = shard_paths(source, args.source_shards)
+    else:
+        sources = [source]
+
+    if not 1 <= args.shards <= SHARD_ID_STRIDE:
+        parser.error(f"--shards must be between 1 and {SHARD_ID_STRIDE}")
+
+    missing = [path for path in sources if not os.path.exists(path)]
+    if missing:
+        parser.error(f"no such database: {', '.join(missing)}")
+
+    targets = shard_paths(args.target, args.shards)
+    try:
+        copied = reshard(sources, targets)
+    except (FileExistsError, sqlite3.Error) as e:
+        sys.exit(f"Resharding failed: {e}")
+
+    print(f"Copied {copied} users into {', '.join(targets)}")
+    print(f"Start the service with STORAGE_BACKEND=sharded DB_SHARDS={args.shards} DB_SHARD_PATTERN='{args.target}'")
+
+if __name__ == '__main__':
+    main()
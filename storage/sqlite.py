@@ -0,0 +1,396 @@
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+import db
+import migrations
+from migrations import USERS_TABLE, ROLES_TABLE, REVOKED_TOKENS_TABLE, REFRESH_TOKENS_TABLE, OUTBOX_TABLE, OUTBOX_PRUNED_TABLE
+from storage.base import UnitOfWork, UserStore
+
+# A user's roles, aggregated as a JSON array so that any character in a role
+# name survives; users without roles get []
+ROLES_ARRAY = 'json_group_array(r.role) FILTER (WHERE r.role IS NOT NULL)'
+# Largest number of values bound in one IN (...) list
+IN_CHUNK_SIZE = 500
+
+def _decode_roles(value):
+    return json.loads(value) if value else []
+
+def _chunks(items, size=IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _select_in(cur, query, column_values):
+    # Run query with its IN (%s) list filled in chunk by chunk
+    rows = []
+    for chunk in _chunks(column_values):
+        cur.execute(query % ','.join('?' * len(chunk)), chunk)
+        rows.extend(cur.fetchall())
+    return rows
+
+def get_roles(user_id, conn):
+    cur = conn.cursor()
+    cur.execute(f'SELECT role FROM {ROLES_TABLE} WHERE user_id = ?', (user_id,))
+    return [row[0] for row in cur.fetchall()]
+
+class SQLiteUnitOfWork(UnitOfWork):
+    def __init__(self, cur):
+        super().__init__()
+        self.cur = cur
+
+    def _user_exists(self, user_id):
+        self.cur.execute(f'SELECT 1 FROM {USERS_TABLE} WHERE id = ?', (user_id,))
+        return self.cur.fetchone() is not None
+
+    def insert_user(self, email, password):
+        self.cur.execute(
+            f'''
+            INSERT OR IGNORE INTO {USERS_TABLE}
+            (email, password)
+            VALUES (?, ?)
+            ''',
+            (email, password)
+        )
+
+        if not self.cur.rowcount:
+            return None
+
+        self.changed.add(self.cur.lastrowid)
+        self.created.add(self.cur.lastrowid)
+        return self.cur.lastrowid
+
+    def add_role(self, user_id, role):
+        # Inserts nothing if there is no such user, instead of failing the
+        # foreign key
+        self.cur.execute(
+            f'INSERT OR IGNORE INTO {ROLES_TABLE} (user_id, role) SELECT id, ? FROM {USERS_TABLE} WHERE id = ?',
+            (role, user_id)
+        )
+
+        if self.cur.rowcount:
+            self.changed.add(user_id)
+            return True
+
+        # The user already had the role, or does not exist
+        return self._user_exists(user_id)
+
+    def remove_role(self, user_id, role):
+        self.cur.execute(f'DELETE FROM {ROLES_TABLE} WHERE user_id = ? and role = ?', (user_id, role))
+
+        if self.cur.rowcount:
+            self.changed.add(user_id)
+            return True
+
+        return self._user_exists(user_id)
+
+    def update_user(self, id, fields):
+        query = f'''
+        UPDATE {USERS_TABLE}
+        SET '''
+
+        i = 0
+        values = []
+        for key, value in fields.items():
+            if key in ('email', 'password') and key not in query:
+                if i > 0:
+                    query += ", "
+
+                query += f'{key} = ?'
+                values.append(value)
+                i += 1
+
+        query += " WHERE id = ?"
+        values.append(id)
+
+        self.cur.execute(query, values)
+
+        if not self.cur.rowcount:
+            return False
+
+        if 'password' in fields:
+            # A new password ends every session, so a stolen refresh token
+            # cannot outlive the reset
+            self.cur.execute(f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE user_id = ?', (id,))
+
+        self.changed.add(id)
+        return True
+
+    def delete_user(self, id):
+        # The user's roles are removed by ON DELETE CASCADE
+        self.cur.execute(f'DELETE FROM {USERS_TABLE} WHERE id = ?', (id,))
+
+        if not self.cur.rowcount:
+            return False
+
+        self.changed.add(id)
+        return True
+
+    def insert_users(self, users):
+        cur = self.cur
+
+        emails = [u['email'] for u in users]
+        existing = {row['email'] for row in _select_in(cur, f'SELECT email FROM {USERS_TABLE} WHERE email IN (%s)', emails)}
+        new_users = [u for u in users if u['email'] not in existing]
+
+        cur.executemany(
+            f'INSERT INTO {USERS_TABLE} (email, password) VALUES (?, ?)',
+            [(u['email'], u['password']) for u in new_users]
+        )
+
+        ids = {row['email']: row['id'] for row in _select_in(cur, f'SELECT id, email FROM {USERS_TABLE} WHERE email IN (%s)', [u['email'] for u in new_users])}
+
+        cur.executemany(
+            f'INSERT OR IGNORE INTO {ROLES_TABLE} (user_id, role) VALUES (?, ?)',
+            [(ids[u['email']], role) for u in new_users for role in (u.get('roles') or ["user"])]
+        )
+
+        self.changed.update(ids.values())
+        self.created.update(ids.values())
+        return ids, existing
+
+    def update_roles(self, changes):
+        cur = self.cur
+
+        ids = list({c['id'] for c in changes})
+        found = {row['id'] for row in _select_in(cur, f'SELECT id FROM {USERS_TABLE} WHERE id IN (%s)', ids)}
+
+        cur.executemany(
+            f'INSERT OR IGNORE INTO {ROLES_TABLE} (user_id, role) VALUES (?, ?)',
+            [(c['id'], c['new_role']) for c in changes if c['id'] in found and c.get('new_role')]
+        )
+        cur.executemany(
+            f'DELETE FROM {ROLES_TABLE} WHERE user_id = ? and role = ?',
+            [(c['id'], c['remove_role']) for c in changes if c['id'] in found and c.get('remove_role')]
+        )
+
+        self.changed.update(found)
+        return found
+
+    def record_changes(self):
+        if not self.changed:
+            return
+
+        rows = _select_in(
+            self.cur,
+            f'''SELECT u.id, u.email, {ROLES_ARRAY} AS roles
+               FROM {USERS_TABLE} u
+               LEFT JOIN {ROLES_TABLE} r ON r.user_id = u.id
+               WHERE u.id IN (%s)
+               GROUP BY u.id''',
+            list(self.changed)
+        )
+        users = {row['id']: {'id': row['id'], 'email': row['email'], 'roles': sorted(_decode_roles(row['roles']))} for row in rows}
+
+        self.cur.executemany(
+            f'INSERT INTO {OUTBOX_TABLE} (user_id, type, data, created_at) VALUES (?, ?, ?, ?)',
+            self._outbox_rows(users, int(time.time()))
+        )
+
+class SQLiteStore(UserStore):
+    """Users and roles in the SQLite file at path (default DB_PATH), through
+    the per-thread connections of db.py."""
+
+    Error = sqlite3.Error
+
+    def __init__(self, path=None):
+        self.path = path or db.DB_PATH
+
+    def _connection(self):
+        return db.get_connection(self.path)
+
+    def _work(self, cur):
+        return SQLiteUnitOfWork(cur)
+
+    def migrate(self):
+        return migrations.migrate(self.path)
+
+    def ping(self):
+        # Reads a page of the file, which SELECT 1 alone would not
+        self._connection().execute(f'SELECT 1 FROM {USERS_TABLE} LIMIT 1').fetchone()
+
+    # ----------------------------------------------------- Reads
+    def list_users(self, after_id=0, limit=None, role=None, email_prefix=None):
+        query = f'''
+            SELECT u.id, u.email, {ROLES_ARRAY} AS roles
+            FROM {USERS_TABLE} u
+            LEFT JOIN {ROLES_TABLE} r ON r.user_id = u.id
+            WHERE u.id > ?'''
+        values = [after_id or 0]
+
+        if email_prefix:
+            # A range instead of LIKE, so the unique index on email is usable
+            query += ' AND u.email >= ? AND u.email < ?'
+            values += [email_prefix, email_prefix + '\U0010ffff']
+
+        if role:
+            query += f' AND EXISTS (SELECT 1 FROM {ROLES_TABLE} f WHERE f.user_id = u.id AND f.role = ?)'
+            values.append(role)
+
+        query += ' GROUP BY u.id ORDER BY u.id'
+
+        if limit:
+            query += ' LIMIT ?'
+            values.append(limit)
+
+        cur = self._connection().cursor()
+        try:
+            cur.execute(query, values)
+            for row in cur:
+                yield {
+                    'id': row['id'],
+                    'email': row['email'],
+                    'roles': _decode_roles(row['roles'])
+                }
+        finally:
+            cur.close()
+
+    def _find_user(self, column, value):
+        with self._connection() as conn:
+            cur = conn.cursor()
+
+            cur.execute(f'SELECT * FROM {USERS_TABLE} WHERE {column} = ?', (value,))
+            data = cur.fetchone()
+
+            if not data:
+                return None
+
+            return {
+                'id': data['id'],
+                'email': data['email'],
+                'password': data['password'],
+                'roles': get_roles(data['id'], conn)
+            }
+
+    def find_user_by_id(self, id):
+        return self._find_user('id', id)
+
+    def find_user_by_email(self, email):
+        return self._find_user('email', email)
+
+    def existing_emails(self, emails):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            rows = _select_in(cur, f'SELECT email FROM {USERS_TABLE} WHERE email IN (%s)', list(emails))
+            return {row['email'] for row in rows}
+
+    # ----------------------------------------------------- Writes
+    @contextmanager
+    def unit_of_work(self):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            # Take the write lock up front, so what the unit reads still
+            # holds when it writes. Held until the commit, it also keeps
+            # outbox ids in commit order.
+            cur.execute('BEGIN IMMEDIATE')
+            work = self._work(cur)
+            yield work
+            work.record_changes()
+
+    def replace_password(self, id, old, new):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'UPDATE {USERS_TABLE} SET password = ? WHERE id = ? AND password = ?', (new, id, old))
+            return cur.rowcount > 0
+
+    # ----------------------------------------------------- Outbox
+    def changes(self, after_id=0, limit=None):
+        query = f'SELECT id, user_id, type, data, created_at FROM {OUTBOX_TABLE} WHERE id > ? ORDER BY id'
+        values = [after_id or 0]
+
+        if limit:
+            query += ' LIMIT ?'
+            values.append(limit)
+
+        cur = self._connection().cursor()
+        cur.execute(query, values)
+        return [
+            {
+                'cursor': row['id'],
+                'type': row['type'],
+                'id': row['user_id'],
+                'user': json.loads(row['data']) if row['data'] is not None else None,
+                'time': row['created_at']
+            }
+            for row in cur.fetchall()
+        ]
+
+    def change_bounds(self):
+        row = self._connection().execute(f'SELECT MIN(id), MAX(id) FROM {OUTBOX_TABLE}').fetchone()
+        return row[0], row[1]
+
+    def last_pruned_change(self):
+        return self._connection().execute(f'SELECT last_id FROM {OUTBOX_PRUNED_TABLE}').fetchone()[0]
+
+    def prune_changes(self, before):
+        condition = f'created_at < ? AND id < (SELECT MAX(id) FROM {OUTBOX_TABLE})'
+
+        # One transaction, under the write lock: the mark covers exactly the
+        # rows deleted
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f'UPDATE {OUTBOX_PRUNED_TABLE} SET last_id = MAX(last_id, COALESCE((SELECT MAX(id) FROM {OUTBOX_TABLE} WHERE {condition}), 0))',
+                (before,)
+            )
+            cur.execute(f'DELETE FROM {OUTBOX_TABLE} WHERE {condition}', (before,))
+
+    # ----------------------------------------------------- Revoked tokens
+    def revoke_token(self, jti, expires_at):
+        with self._connection() as conn:
+            conn.cursor().execute(
+                f'INSERT OR IGNORE INTO {REVOKED_TOKENS_TABLE} (jti, expires_at) VALUES (?, ?)',
+                (jti, expires_at)
+            )
+
+    def revoked_tokens(self, after_id=0, now=0):
+        cur = self._connection().cursor()
+        cur.execute(
+            f'SELECT id, jti, expires_at FROM {REVOKED_TOKENS_TABLE} WHERE id > ? AND expires_at > ? ORDER BY id',
+            (after_id, now)
+        )
+        return [tuple(row) for row in cur.fetchall()]
+
+    def prune_revoked_tokens(self, now):
+        with self._connection() as conn:
+            conn.cursor().execute(f'DELETE FROM {REVOKED_TOKENS_TABLE} WHERE expires_at <= ?', (now,))
+
+    # ----------------------------------------------------- Refresh tokens
+    def insert_refresh_token(self, token_hash, family, user_id, expires_at, now):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE user_id = ? AND expires_at <= ?', (user_id, now))
+            cur.execute(
+                f'INSERT INTO {REFRESH_TOKENS_TABLE} (token_hash, family, user_id, expires_at) VALUES (?, ?, ?, ?)',
+                (token_hash, family, user_id, expires_at)
+            )
+
+    def rotate_refresh_token(self, token_hash, new_hash, expires_at, now):
+        with self._connection() as conn:
+            cur = conn.cursor()
+            # Two refreshes with the same token must not both succeed
+            cur.execute('BEGIN IMMEDIATE')
+
+            cur.execute(f'SELECT family, user_id, expires_at, used FROM {REFRESH_TOKENS_TABLE} WHERE token_hash = ?', (token_hash,))
+            row = cur.fetchone()
+
+            if row is None or row['expires_at'] <= now:
+                return None
+
+            if row['used']:
+                # A used token presented again was copied: end the session
+                cur.execute(f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE family = ?', (row['family'],))
+                return None
+
+            cur.execute(f'UPDATE {REFRESH_TOKENS_TABLE} SET used = 1 WHERE token_hash = ?', (token_hash,))
+            cur.execute(
+                f'INSERT INTO {REFRESH_TOKENS_TABLE} (token_hash, family, user_id, expires_at) VALUES (?, ?, ?, ?)',
+                (new_hash, row['family'], row['user_id'], expires_at)
+            )
+            return row['user_id']
+
+    def delete_refresh_token_family(self, token_hash):
+        with self._connection() as conn:
+            conn.cursor().execute(
+                f'DELETE FROM {REFRESH_TOKENS_TABLE} WHERE family = (SELECT family FROM {REFRESH_TOKENS_TABLE} WHERE token_hash = ?)',
+                (token_hash,)
+            )
@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+
+# Settings are read when the modules are imported
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'users.db')
+os.environ['SECRET_KEY'] = 'test-secret-0123456789abcdef0123456789'
+os.environ['BCRYPT_ROUNDS'] = '4'
+os.environ['HASH_EXECUTOR'] = 'thread'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as appmod
+import user
+
+def test_password_change_ends_refresh_sessions():
+    client = appmod.app.test_client(use_cookies=False)
+
+    assert client.post('/register', json={'email': 'admin@example.com', 'password': 'pw'}).status_code == 201
+    assert client.post('/register', json={'email': 'owner@example.com', 'password': 'old'}).status_code == 201
+    admin_id = user.get_user_by_email('admin@example.com')[1]['id']
+    owner_id = user.get_user_by_email('owner@example.com')[1]['id']
+    assert user.add_role(admin_id, 'admin')[0] == 201
+
+    admin = client.post('/login', json={'email': 'admin@example.com', 'password': 'pw'}).get_json()
+    owner = client.post('/login', json={'email': 'owner@example.com', 'password': 'old'}).get_json()
+
+    r = client.patch(
+        f'/users/{owner_id}',
+        json={'old_password': 'old', 'new_password': 'new'},
+        headers={'Authorization': admin['Authorization']}
+    )
+    assert r.status_code == 200
+
+    r = client.post('/token/refresh', json={'refresh_token': owner['refresh_token']})
+    assert r.status_code == 401
+
+    # Other users' sessions are left alone
+    r = client.post('/token/refresh', json={'refresh_token': admin['refresh_token']})
+    assert r.status_code == 200
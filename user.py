@@ -1,257 +1,329 @@
-import sqlite3
-from dotenv import load_dotenv
 import os
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import changes
+import hashing
+import metrics
+import storage
+from cache import TTLCache
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 30))
+
+# Where users and roles are stored, chosen by STORAGE_BACKEND (see storage/)
+backend = storage.get_backend()
+
+# Read-through cache of user records (with roles, without the password hash)
+# for the lookups done on every role change and token refresh. Writes in this
+# module invalidate the records they touch; USER_CACHE_TTL bounds how long
+# another process's changes can go unseen. Password checks always read the
+# database, so an old password stops working everywhere at once.
+_users_by_id = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_ids_by_email = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_cache_lock = threading.Lock()
+_generation = 0
+
+# Password hashes being upgraded to the current bcrypt cost, by user id. One
+# thread does the upgrades, so they queue up instead of competing with logins.
+_rehash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rehash')
+_rehashing = set()
+_rehashing_lock = threading.Lock()
+REHASHES = metrics.Counter('password_rehashes_total', 'Stored password hashes upgraded after a login, by result', ['result'])
+
+@contextmanager
+def unit_of_work():
+    """Run several writes in one transaction on one connection (see
+    storage.base.UnitOfWork): either all of them are committed or none.
+    The cached records of the users written are dropped after the commit,
+    and readers waiting on GET /changes are woken. Raises backend.Error."""
+    with backend.unit_of_work() as work:
+        yield work
+
+    for id in work.changed:
+        invalidate_user(id)
+
+    if work.changed:
+        changes.notify()
 
-# Load environment variables from .env file
-load_dotenv()
-DB_PATH = os.getenv('DB_PATH', "users.db")
-USERS_TABLE = "users"
-ROLES_TABLE = "roles"
-
-def create_table():
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-
-        cur.execute(f'''CREATE TABLE IF NOT EXISTS {USERS_TABLE} (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT NOT NULL UNIQUE,
-                    password TEXT NOT NULL
-                )''')
-
-        cur.execute(f'''CREATE TABLE IF NOT EXISTS {ROLES_TABLE} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES {USERS_TABLE} (id),
-                UNIQUE (user_id, role)
-            )''')
-        
 def register_user(data):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            
-            cur.execute(
-                f'''
-                INSERT OR IGNORE INTO {USERS_TABLE} 
-                (email, password) 
-                VALUES (?, ?)
-                ''',
-                (
-                    data.get('email'),
-                    data.get('password')
-                )
-            )
-
-        status, result = add_role(data.get('email'), "user")
-
-        if (status != 201):
-            return [status, {"message": f"New user added to database but could not add a role: {result}"}]
+        # The user and their first role are committed together, using the
+        # id the insert returned
+        with unit_of_work() as work:
+            id = work.insert_user(data.get('email'), data.get('password'))
+
+            if id is None:
+                return [409, {"message": "A user with this email already exists"}]
+
+            work.add_role(id, "user")
 
         return [201, {"message": "New user added to database"}]
 
-    except sqlite3.Error as e:
+    except backend.Error as e:
         return [500, {"error": str(e)}]
-    
-def get_users():
+
+def get_users(after_id=None, limit=None, role=None, email_prefix=None):
+    """List users ordered by id, with their roles, in a single query.
+
+    Keyset pagination: pass the last id of the previous page as after_id.
+    The result is a generator, so rows are read from the database while the
+    response is being written instead of being loaded into memory first.
+    """
     try:
-        data = None
+        rows = backend.list_users(after_id or 0, limit, role, email_prefix)
+        first = next(rows, None)
 
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            
-            cur.execute(f'SELECT * FROM {USERS_TABLE}')
-            data = cur.fetchall()
-            
-            if not data:
-                return [404, {"message": "No users found"}]
-
-        newData = []
-        for user in data:
-            status, roles = get_roles(user['id'], conn)
-            
-            newData.append({
-                'id': user['id'],
-                'email': user['email'],
-                'roles': roles if status == 200 else []
-            })
-
-        return [200, newData]
-
-    except sqlite3.Error as e:
+        if first is None:
+            return [404, {"message": "No users found"}]
+
+        return [200, itertools.chain([first], rows)]
+
+    except backend.Error as e:
         return [500, {"error": str(e)}]
 
+def _get_cached(id):
+    record = _users_by_id.get(id)
+    return dict(record, roles=list(record['roles'])) if record is not None else None
+
+def _load_user(find, value, credentials=False):
+    # Only cache what was read if nothing was invalidated in the meantime,
+    # otherwise a slow read could put back a record that was just changed
+    generation = _generation
+
+    record = find(value)
+
+    if not record:
+        return None
+
+    cached = {key: value for key, value in record.items() if key != 'password'}
+
+    with _cache_lock:
+        if generation == _generation:
+            _users_by_id.set(record['id'], cached)
+            _ids_by_email.set(record['email'], record['id'])
+
+    return dict(record if credentials else cached, roles=list(record['roles']))
+
+def invalidate_user(id):
+    """Drop a user from the cache after it was changed in the database."""
+    global _generation
+
+    with _cache_lock:
+        _generation += 1
+        _users_by_id.pop(id)
+
 def get_user(id):
     try:
-        data = None
+        data = _get_cached(id) or _load_user(backend.find_user_by_id, id)
 
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            
-            cur.execute(f'SELECT * FROM {USERS_TABLE} WHERE id = ?', (id,))
-            data = cur.fetchone()
-            
-            if not data:
-                return [404, {"message": "User not found"}]
-            
-        status, roles = get_roles(data['id'], conn)
-                
-        return [200, {
-            'id': data['id'],
-            'email': data['email'],
-            'password': data['password'],
-            'roles': roles if status == 200 else []
-        }]
-
-    except sqlite3.Error as e:
+        if not data:
+            return [404, {"message": "User not found"}]
+
+        return [200, data]
+
+    except backend.Error as e:
         return [500, {"error": str(e)}]
 
 def get_user_by_email(email):
     try:
         data = None
+        id = _ids_by_email.get(email)
 
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            
-            cur.execute(f'SELECT * FROM {USERS_TABLE} WHERE email = ?', (email,))
-            data = cur.fetchone()
-            
-            if not data:
-                return [404, {"message": "User not found"}]
-            
-        status, roles = get_roles(data['id'], conn)
-                
-        return [200, {
-            'id': data['id'],
-            'email': data['email'],
-            'password': data['password'],
-            'roles': roles if status == 200 else []
-        }]
-
-    except sqlite3.Error as e:
+        if id is not None:
+            data = _get_cached(id)
+            # The email may have changed since it was cached
+            if data and data['email'] != email:
+                data = None
+
+        data = data or _load_user(backend.find_user_by_email, email)
+
+        if not data:
+            return [404, {"message": "User not found"}]
+
+        return [200, data]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def get_user_credentials(email):
+    """The user with this email, with their password hash, read from the
+    database rather than the cache."""
+    try:
+        data = _load_user(backend.find_user_by_email, email, credentials=True)
+
+        if not data:
+            return [404, {"message": "User not found"}]
+
+        return [200, data]
+
+    except backend.Error as e:
         return [500, {"error": str(e)}]
 
 def get_user_password(id):
+    """A user's password hash, read from the database rather than the cache."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            
-            cur.execute(f'SELECT password FROM {USERS_TABLE} WHERE id = ?', (id,))
-            data = cur.fetchone()
-            
-            if not data:
-                return [404, {"message": "User not found"}]
+        data = _load_user(backend.find_user_by_id, id, credentials=True)
+
+        if not data:
+            return [404, {"message": "User not found"}]
 
-            return [200, data["password"]]
+        return [200, data['password']]
 
-    except sqlite3.Error as e:
+    except backend.Error as e:
         return [500, {"error": str(e)}]
 
+def clear_cache():
+    global _generation
+
+    with _cache_lock:
+        _generation += 1
+        _users_by_id.clear()
+        _ids_by_email.clear()
+
+def cache_stats():
+    return {
+        "users_by_id": _users_by_id.stats(),
+        "ids_by_email": _ids_by_email.stats()
+    }
+
+metrics.add_collector(lambda: metrics.gauge_lines(
+    'user_cache', 'User record cache counters',
+    {(cache, key): value for cache, stats in cache_stats().items() for key, value in stats.items()},
+    ['cache', 'stat']
+))
+
 def update_user(id, data):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            
-            query = f'''
-            UPDATE {USERS_TABLE}
-            SET '''
-
-            i = 0
-            values = []
-            for key,value in data.items():
-                if key not in query:
-                    if i > 0:
-                        query+= ", "
-
-                    query += f'{key} = ?'
-                    values.append(value)
-                    i += 1
-
-            query += f" WHERE id = {id}"
-            print(query)
-
-            cur.execute(query, (values))
-            if cur.rowcount == 0:
+        with unit_of_work() as work:
+            if not work.update_user(id, data):
                 return [404, {"message": "User not found."}]
-            
-            return [200, {"message": "User updated successfully."}]
 
-    except sqlite3.Error as e:
+        return [200, {"message": "User updated successfully."}]
+
+    except backend.Error as e:
         return [500, {"error": str(e)}]
-    
+
+def upgrade_password_hash(id, password, hashed):
+    """After a successful login, rehash the password in the background if its
+    stored hash has an outdated cost or bcrypt variant (see hashing.needs_rehash).
+
+    The new hash only replaces the one the login was checked against, so a
+    password changed in the meantime is kept.
+    """
+    if not hashing.needs_rehash(hashed):
+        return
+
+    with _rehashing_lock:
+        if id in _rehashing:
+            return
+        _rehashing.add(id)
+
+    _rehash_executor.submit(_rehash, id, password, hashed)
+
+def _rehash(id, password, hashed):
+    try:
+        new_hash = hashing.hash_password(password)
+
+        if backend.replace_password(id, hashed, new_hash):
+            invalidate_user(id)
+            REHASHES.inc('upgraded')
+        else:
+            REHASHES.inc('changed')
+
+    # Tried again at the user's next login
+    except hashing.HashingBusy:
+        REHASHES.inc('busy')
+    except backend.Error:
+        REHASHES.inc('error')
+
+    finally:
+        with _rehashing_lock:
+            _rehashing.discard(id)
+
 def delete_user(id):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            
-            cur.execute(
-                f'DELETE FROM {USERS_TABLE} WHERE id = ?',
-                (id,)
-            )
-            cur.execute(
-                f'DELETE FROM {ROLES_TABLE} WHERE user_id = ?',
-                (id,)
-            )
-            return [201, {"message": "User removed from database"}]
-            
-    except sqlite3.Error as e:
+        with unit_of_work() as work:
+            work.delete_user(id)
+
+        return [201, {"message": "User removed from database"}]
+
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def add_role(id, role):
+    try:
+        with unit_of_work() as work:
+            if not work.add_role(id, role):
+                return [404, {"message": "User not found"}]
+
+        return [201, {"message": "New user role added to database"}]
+
+    except backend.Error as e:
         return [500, {"error": str(e)}]
 
-def add_role(email, role):
+def remove_role(id, role):
     try:
-        status, result = get_user_by_email(email)
+        with unit_of_work() as work:
+            if not work.remove_role(id, role):
+                return [404, {"message": "User not found"}]
 
-        if status != 200:
-            return [404, {"message": "User not found"}]
+        return [201, {"message": "User role removed from database"}]
 
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            
-            cur.execute(
-                f'INSERT OR IGNORE INTO {ROLES_TABLE} (user_id, role) VALUES (?, ?)',
-                (result['id'], role)
-            )
-            return [201, {"message": "New user role added to database"}]
-            
-    except sqlite3.Error as e:
+    except backend.Error as e:
         return [500, {"error": str(e)}]
 
-def remove_role(email, role):
+def get_existing_emails(emails):
     try:
-        status, result = get_user_by_email(email)
+        return [200, backend.existing_emails(emails)]
 
-        if status != 200:
-            return [404, {"message": "User not found"}]
+    except backend.Error as e:
+        return [500, {"error": str(e)}]
+
+def register_users(users):
+    """Insert many users and their roles in a single transaction.
+
+    users is a list of {'email', 'password', 'roles'} dicts with hashed
+    passwords. Returns one result per user, in the same order: 201 with the
+    new id, or 409 if the email is already taken.
+    """
+    try:
+        with unit_of_work() as work:
+            ids, existing = work.insert_users(users)
+
+        results = []
+        for u in users:
+            if u['email'] in existing:
+                results.append({"email": u['email'], "status": 409, "message": "A user with this email already exists"})
+            else:
+                results.append({"email": u['email'], "id": ids[u['email']], "status": 201, "message": "New user added to database"})
 
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            
-            cur.execute(
-                f'DELETE FROM {ROLES_TABLE} WHERE user_id = ? and role = ?',
-                (result['id'], role)
-            )
-            return [201, {"message": "User role removed from database"}]
-            
-    except sqlite3.Error as e:
+        return [200, results]
+
+    except backend.Error as e:
         return [500, {"error": str(e)}]
-    
 
-def get_roles(user_id, conn):
+def update_roles(rows):
+    """Add and remove many roles in a single transaction.
+
+    rows is a list of {'id', 'new_role'} or {'id', 'remove_role'} dicts.
+    Returns one result per change, in the same order.
+    """
     try:
-        cur = conn.cursor()
-        cur.execute('SELECT role FROM roles WHERE user_id = ?', (user_id,))
-        data = cur.fetchall()
+        with unit_of_work() as work:
+            found = work.update_roles(rows)
 
-        if data:
-            return [200, [row[0] for row in data]]  # Extract roles into a list
-        else:
-            return [404, {"message": "No roles found"}]
+        results = []
+        for c in rows:
+            if c['id'] not in found:
+                results.append({"id": c['id'], "status": 404, "message": "User not found"})
+            elif c.get('new_role'):
+                results.append({"id": c['id'], "status": 201, "message": "New user role added to database"})
+            else:
+                results.append({"id": c['id'], "status": 201, "message": "User role removed from database"})
+
+        return [200, results]
 
-    except sqlite3.Error as e:
+    except backend.Error as e:
         return [500, {"error": str(e)}]
-    
-create_table()
\ No newline at end of file